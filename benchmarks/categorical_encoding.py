@@ -0,0 +1,71 @@
+# Memory and upload size of the clean frames with and without categorical encoding.
+#
+# Builds synthetic users/products frames shaped like the API data (few distinct
+# genders, cities, categories and brands over many rows), then compares in-memory
+# size, pickled size (what crosses process boundaries) and the Parquet bytes
+# uploaded to BigQuery as plain object columns versus dictionary-encoded categoricals.
+#
+# Usage (from the project root):  python -m benchmarks.categorical_encoding [--rows 200000]
+import argparse
+import pickle
+import random
+from datetime import datetime
+
+import pandas as pd
+
+from scripts.load_data import dataframe_to_parquet, get_clean_table_schemas
+from scripts.transform_data import encode_categoricals
+
+CITIES = [f"City {i}" for i in range(40)]
+CATEGORIES = ['beauty', 'fragrances', 'furniture', 'groceries', 'laptops', 'smartphones', 'home-decoration']
+BRANDS = [f"Brand {i}" for i in range(60)]
+
+def synthetic_users(rows):
+    return pd.DataFrame({
+        'user_id': range(1, rows + 1),
+        'first_name': [f"First{i}" for i in range(rows)],
+        'last_name': [f"Last{i}" for i in range(rows)],
+        'gender': [random.choice(['male', 'female']) for _ in range(rows)],
+        'age': [random.randint(18, 80) for _ in range(rows)],
+        'street': [f"{i} Main Street" for i in range(rows)],
+        'city': [random.choice(CITIES) for _ in range(rows)],
+        'postal_code': [f"{random.randint(10000, 99999)}" for _ in range(rows)],
+        'load_timestamp': datetime.now(),
+    })
+
+def synthetic_products(rows):
+    return pd.DataFrame({
+        'product_id': range(1, rows + 1),
+        'name': [f"Product {i}" for i in range(rows)],
+        'category': [random.choice(CATEGORIES) for _ in range(rows)],
+        'brand': [random.choice(BRANDS) for _ in range(rows)],
+        'price': [round(random.uniform(50, 2000), 2) for _ in range(rows)],
+        'load_timestamp': datetime.now(),
+    })
+
+def measure(df, schema):
+    return {
+        'memory_mb': df.memory_usage(deep=True).sum() / 1e6,
+        'pickle_mb': len(pickle.dumps(df)) / 1e6,
+        'parquet_mb': dataframe_to_parquet(df, schema).getbuffer().nbytes / 1e6,
+    }
+
+def run(rows):
+    schemas = get_clean_table_schemas()
+    for data_type, build in (('users', synthetic_users), ('products', synthetic_products)):
+        plain = build(rows)
+        encoded = encode_categoricals(plain.copy(), data_type)
+        before, after = measure(plain, schemas[data_type]), measure(encoded, schemas[data_type])
+
+        print("=" * 60)
+        print(f"{data_type}: {rows} rows")
+        for metric in ('memory_mb', 'pickle_mb', 'parquet_mb'):
+            print(f"  {metric:<11} object {before[metric]:8.2f}  categorical {after[metric]:8.2f}  "
+                  f"({before[metric] / after[metric]:.1f}x smaller)")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare object and categorical encodings of the clean frames")
+    parser.add_argument('--rows', type=int, default=200000)
+    args = parser.parse_args()
+
+    run(args.rows)
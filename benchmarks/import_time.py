@@ -0,0 +1,128 @@
+# Import-time benchmark for the pipeline modules, with an enforced budget.
+#
+# Each module is imported in a fresh interpreter (as the scheduler and task
+# runners do), timed with `python -X importtime`, and checked that none of the
+# heavy dependencies were actually executed at import time. DAG files are
+# imported with Airflow preloaded, as the scheduler's DAG processor does.
+#
+# Usage (from the project root):  python -m benchmarks.import_time
+# Exits with status 1 when a module is over budget or eagerly loads a heavy dependency.
+# The same checks run per module in tests/test_import_time.py.
+import os
+import re
+import statistics
+import subprocess
+import sys
+
+PROJECT_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Cumulative import time allowed per module, in milliseconds
+IMPORT_TIME_BUDGET_MS = 150
+
+# Number of fresh-interpreter runs per module (the median is reported)
+RUNS = 5
+
+MODULES = [
+    'config.gcp_config',
+    'scripts.extract_data',
+    'scripts.transform_data',
+    'scripts.load_data',
+    'scripts.queries',
+    'scripts.backfill',
+    'scripts.compact_raw',
+    'scripts.micro_batch',
+    'scripts.sketches',
+    'scripts.raw_cache',
+    'scripts.raw_codecs',
+    'scripts.raw_lake',
+    'scripts.validate_data',
+    'scripts.io_control',
+    'scripts.memory_budget',
+    'scripts.lazy_imports',
+    # Airflow plugin and DAG files, imported the way the scheduler parses them (dags/ and plugins/ on the path)
+    'bigquery_deferrable',
+    'savannah_etl_pipeline',
+    'savannah_lake_compaction',
+]
+
+# The scheduler parses DAG files (and loads plugins) with Airflow already imported, so that is not charged to them
+PRELOADED = {
+    'bigquery_deferrable': ['airflow'],
+    'savannah_etl_pipeline': ['airflow'],
+    'savannah_lake_compaction': ['airflow'],
+}
+
+# Extra import paths, as Airflow puts its dags/ and plugins/ folders on sys.path
+IMPORT_PATHS = ['dags', 'plugins']
+
+# A heavy dependency counts as loaded once one of its internal submodules is imported
+HEAVY_MARKERS = {
+    'pandas': 'pandas.core.frame',
+    'google.cloud.bigquery': 'google.cloud.bigquery.client',
+    'google.cloud.storage': 'google.cloud.storage.client',
+    'requests': 'requests.sessions',
+    'numpy': 'numpy.linalg',
+    'pyarrow': 'pyarrow.lib',
+}
+
+IMPORTTIME_LINE = re.compile(r"import time:\s+(\d+)\s+\|\s+(\d+)\s+\|\s+(\S+)\s*$")
+
+def run_python(code):
+    """Run code in a fresh interpreter from the project root, with the DAG import paths set"""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [PROJECT_ROOT] + [os.path.join(PROJECT_ROOT, path) for path in IMPORT_PATHS]
+        + ([env['PYTHONPATH']] if env.get('PYTHONPATH') else [])
+    )
+    return subprocess.run(code, cwd=PROJECT_ROOT, capture_output=True, text=True, env=env)
+
+def preload_statement(module):
+    return "".join(f"import {name}; " for name in PRELOADED.get(module, []))
+
+def measure_import_ms(module):
+    """Cumulative import time of a module in a fresh interpreter, in milliseconds"""
+    result = run_python([sys.executable, '-X', 'importtime', '-c', f'{preload_statement(module)}import {module}'])
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr.strip().splitlines()[-1]}")
+
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if match and match.group(3) == module:
+            return int(match.group(2)) / 1000
+    raise RuntimeError(f"No import time reported for {module}")
+
+def eagerly_loaded(module):
+    """Heavy dependencies that were really executed when importing a module (not its preloads)"""
+    check = (
+        f"import sys; {preload_statement(module)}"
+        f"before = set(sys.modules); import {module}; "
+        f"print(','.join(name for name, marker in {HEAVY_MARKERS!r}.items() "
+        f"if marker in sys.modules and marker not in before))"
+    )
+    result = run_python([sys.executable, '-c', check])
+    if result.returncode != 0:
+        raise RuntimeError(f"Importing {module} failed:\n{result.stderr.strip().splitlines()[-1]}")
+    return [name for name in result.stdout.strip().split(',') if name]
+
+def run_benchmark():
+    """Benchmark every module and return True when all are within budget"""
+    print(f"Import-time budget: {IMPORT_TIME_BUDGET_MS} ms per module ({RUNS} runs, median)")
+    print("=" * 60)
+
+    within_budget = True
+    for module in MODULES:
+        median_ms = statistics.median(measure_import_ms(module) for _ in range(RUNS))
+        heavy = eagerly_loaded(module)
+
+        ok = median_ms <= IMPORT_TIME_BUDGET_MS and not heavy
+        within_budget = within_budget and ok
+
+        status = "OK  " if ok else "FAIL"
+        note = f"  (eagerly loads: {', '.join(heavy)})" if heavy else ""
+        print(f"{status} {module:<28} {median_ms:8.1f} ms{note}")
+
+    print("=" * 60)
+    return within_budget
+
+if __name__ == "__main__":
+    sys.exit(0 if run_benchmark() else 1)
@@ -0,0 +1,127 @@
+# Drives the shared I/O controller against a local stub server that throttles and stalls.
+#
+# The stub enforces its own rate limit (429 + Retry-After beyond it), fails a share of
+# requests with 503 and makes a share of responses slow, so the controller's backoff,
+# AIMD concurrency and hedging can be observed without touching the real APIs or GCS.
+#
+# Usage (from the project root):  python -m benchmarks.io_control_stub [--requests 300]
+import argparse
+import json
+import random
+import statistics
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from config.gcp_config import IO_CONTROL_CONFIG
+from scripts.io_control import IOController
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Answers GETs with a small JSON body, injecting throttling, errors and slow responses"""
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.bucket_tokens = min(
+                server.burst, server.bucket_tokens + (time.monotonic() - server.bucket_updated) * server.rate
+            )
+            server.bucket_updated = time.monotonic()
+            allowed = server.bucket_tokens >= 1
+            if allowed:
+                server.bucket_tokens -= 1
+
+        if not allowed:
+            self.send_response(429)
+            self.send_header('Retry-After', '0.2')
+            self.end_headers()
+            return
+        if random.random() < server.error_rate:
+            self.send_response(503)
+            self.end_headers()
+            return
+        if random.random() < server.slow_rate:
+            time.sleep(server.slow_seconds)
+
+        body = json.dumps({'users': [{'id': i} for i in range(30)]}).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_stub_server(rate, burst, error_rate, slow_rate, slow_seconds):
+    """Start the stub server on a free localhost port in a background thread"""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.rate, server.burst = rate, burst
+    server.bucket_tokens, server.bucket_updated = float(burst), time.monotonic()
+    server.error_rate, server.slow_rate, server.slow_seconds = error_rate, slow_rate, slow_seconds
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def get_json(url, timeout):
+    """GET a JSON document with urllib (raises HTTPError, which carries the status code)"""
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        return json.loads(response.read())
+
+def run(num_requests, client_threads, hedge_after):
+    server = start_stub_server(rate=40, burst=10, error_rate=0.05, slow_rate=0.05, slow_seconds=1.5)
+    url = f"http://127.0.0.1:{server.server_address[1]}/users"
+
+    config = {
+        **IO_CONTROL_CONFIG['default'],
+        # Just under the stub's own limit, so most 429s come from bursts, not the steady rate
+        'rate_per_second': 35,
+        'burst': 10,
+        'max_concurrency': client_threads,
+        'target_latency_seconds': 0.5,
+        'timeout_seconds': 5,
+        'backoff_base_seconds': 0.05,
+        'backoff_max_seconds': 2,
+        'max_attempts': 8,
+        'hedge_after_seconds': hedge_after,
+    }
+    controller = IOController('stub', config)
+    latencies = []
+    failures = 0
+
+    def one_request(_):
+        started = time.monotonic()
+        controller.call(get_json, url, config['timeout_seconds'])
+        return time.monotonic() - started
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=client_threads) as executor:
+        futures = [executor.submit(one_request, i) for i in range(num_requests)]
+        for future in futures:
+            try:
+                latencies.append(future.result())
+            except Exception:
+                failures += 1
+    elapsed = time.monotonic() - started
+    server.shutdown()
+
+    latencies.sort()
+    print("=" * 60)
+    print(f"Hedging: {'after %.2fs' % hedge_after if hedge_after else 'off'}")
+    print(f"Completed {len(latencies)}/{num_requests} requests in {elapsed:.2f}s "
+          f"({len(latencies) / elapsed:.1f} req/s), {failures} failed")
+    if latencies:
+        print(f"Latency p50 {statistics.median(latencies) * 1000:.0f} ms, "
+              f"p99 {latencies[int(len(latencies) * 0.99) - 1] * 1000:.0f} ms")
+    print(f"Controller: {controller.stats()}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Exercise the I/O controller against a throttling stub server")
+    parser.add_argument('--requests', type=int, default=300)
+    parser.add_argument('--threads', type=int, default=16)
+    args = parser.parse_args()
+
+    run(args.requests, args.threads, hedge_after=None)
+    run(args.requests, args.threads, hedge_after=1.0)
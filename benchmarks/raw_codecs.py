@@ -0,0 +1,89 @@
+# Encode/decode speed and size of every raw snapshot codec.
+#
+# Builds a synthetic snapshot shaped like the DummyJSON carts payload (nested
+# product lists, floats, repeated keys) and times each codec's encode and decode,
+# reporting the stored size relative to plain JSON. Codecs whose optional package
+# (orjson, msgpack, zstandard) is not installed are skipped.
+#
+# Usage (from the project root):  python -m benchmarks.raw_codecs [--carts 20000] [--runs 5]
+import argparse
+import random
+import statistics
+import time
+
+from scripts import raw_codecs
+
+CODECS = [
+    'json',
+    'json+gzip',
+    'json+zstd',
+    'orjson',
+    'orjson+gzip',
+    'orjson+zstd',
+    'msgpack',
+    'msgpack+gzip',
+    'msgpack+zstd',
+]
+
+def synthetic_carts(num_carts):
+    carts = []
+    for cart_id in range(1, num_carts + 1):
+        products = [
+            {
+                'id': random.randint(1, 200),
+                'title': f"Product {random.randint(1, 200)}",
+                'price': round(random.uniform(1, 2000), 2),
+                'quantity': random.randint(1, 5),
+                'total': round(random.uniform(1, 10000), 2),
+                'discountPercentage': round(random.uniform(0, 20), 2),
+                'discountedTotal': round(random.uniform(1, 10000), 2),
+                'thumbnail': f"https://cdn.dummyjson.com/products/images/{random.randint(1, 200)}/thumbnail.png",
+            }
+            for _ in range(random.randint(1, 6))
+        ]
+        carts.append({
+            'id': cart_id,
+            'products': products,
+            'total': round(sum(p['total'] for p in products), 2),
+            'discountedTotal': round(sum(p['discountedTotal'] for p in products), 2),
+            'userId': random.randint(1, 200),
+            'totalProducts': len(products),
+            'totalQuantity': sum(p['quantity'] for p in products),
+        })
+    return {'carts': carts, 'total': num_carts, 'skip': 0, 'limit': num_carts}
+
+def time_median(fn, runs):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = fn()
+        timings.append(time.perf_counter() - started)
+    return statistics.median(timings), result
+
+def run(num_carts, runs):
+    data = synthetic_carts(num_carts)
+    baseline_size = None
+
+    print(f"Synthetic carts snapshot: {num_carts} carts, median of {runs} runs")
+    print(f"{'codec':<14} {'encode ms':>10} {'decode ms':>10} {'size MB':>9} {'vs json':>8}")
+    for codec in CODECS:
+        try:
+            encode_seconds, payload = time_median(lambda: raw_codecs.encode(data, codec), runs)
+            decode_seconds, decoded = time_median(lambda: raw_codecs.decode(payload, codec), runs)
+        except ImportError as e:
+            print(f"{codec:<14} skipped: {e}")
+            continue
+        if decoded != data:
+            raise AssertionError(f"{codec} did not round-trip the snapshot")
+
+        baseline_size = baseline_size or len(payload)
+        print(f"{codec:<14} {encode_seconds * 1000:>10.1f} {decode_seconds * 1000:>10.1f} "
+              f"{len(payload) / 1e6:>9.2f} {len(payload) / baseline_size:>7.0%}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the raw snapshot codecs")
+    parser.add_argument('--carts', type=int, default=20000)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    run(args.carts, args.runs)
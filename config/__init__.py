@@ -0,0 +1 @@
+# Configuration for the Savannah ETL pipeline
@@ -6,12 +6,16 @@ from datetime import datetime
 GCP_PROJECT_ID = "sil-data-engineering-2025"
 GCS_BUCKET_NAME = "sil-data-bucket"
 BQ_DATASET = "savannah_analytics"
+BQ_LOCATION = "US"
 
 # Google Cloud Storage (Data Lake) Raw data paths
 GCS_RAW_USERS_PATH = "raw/users/"
 GCS_RAW_PRODUCTS_PATH = "raw/products/"
 GCS_RAW_CARTS_PATH = "raw/carts/"
 
+# Rows rejected by pre-load validation (Parquet, with reasons)
+GCS_QUARANTINE_PATH = "quarantine/"
+
 #BigQuery Cleaned Tables Paths
 BQ_CLEAN_USERS_TABLE = "users_table"
 BQ_CLEAN_PRODUCTS_TABLE = "products_table"
@@ -21,6 +25,8 @@ BQ_CLEAN_CARTS_TABLE = "carts_table"
 BQ_USER_SUMMARY_TABLE = "user_summary"
 BQ_CATEGORY_SUMMARY_TABLE = "category_summary"
 BQ_CART_DETAILS_TABLE = "cart_details"
+BQ_CATEGORY_BUYERS_TABLE = "category_buyers_summary"
+BQ_CITY_SPEND_TABLE = "city_spend_summary"
 
 # Incremental Loading Tables
 BQ_METADATA_TABLE = "pipeline_metadata"
@@ -28,6 +34,11 @@ BQ_STAGING_USERS_TABLE = "staging_users"
 BQ_STAGING_PRODUCTS_TABLE = "staging_products"
 BQ_STAGING_CARTS_TABLE = "staging_carts"
 
+# Micro-batch streaming tables (compacted periodically into the clean tables)
+BQ_STREAM_USERS_TABLE = "users_stream"
+BQ_STREAM_PRODUCTS_TABLE = "products_stream"
+BQ_STREAM_CARTS_TABLE = "carts_stream"
+
 # API Endpoints
 API_URLS = {
     'users': 'https://dummyjson.com/users',
@@ -52,4 +63,98 @@ INCREMENTAL_CONFIG = {
         'timestamp_field': 'updated_at', 
         'lookback_days': 7
     }
-}
\ No newline at end of file
+}
+
+# Deferrable BigQuery job polling (seconds) used by the triggerer
+BQ_JOB_POLL_CONFIG = {
+    'poll_interval': 5,
+    'max_poll_interval': 60,
+    'backoff_factor': 1.5
+}
+
+# Historical backfill / replay from the raw data lake
+BACKFILL_CONFIG = {
+    'max_workers': 8
+}
+
+# Raw data lake compaction into date-partitioned Parquet
+COMPACTION_CONFIG = {
+    'prefix': 'compacted',
+    'compression': 'zstd'
+}
+
+# Shared I/O control per host (API and GCS): token-bucket rate limit, AIMD adaptive
+# concurrency, jittered exponential backoff and optional hedged requests.
+# Host entries override 'default'. Controllers are shared within a process only, so
+# 'processes' is how many processes call the host at once; each takes that share of
+# 'rate_per_second' and 'burst' (the DAG runs one extract per entity in parallel).
+IO_CONTROL_CONFIG = {
+    'default': {
+        'rate_per_second': 10,
+        'burst': 20,
+        'initial_concurrency': 4,
+        'min_concurrency': 1,
+        'max_concurrency': 32,
+        'target_latency_seconds': 2.0,
+        'timeout_seconds': 30,
+        'max_attempts': 5,
+        'backoff_base_seconds': 0.5,
+        'backoff_max_seconds': 30,
+        'hedge_after_seconds': None,
+        'processes': 1
+    },
+    'dummyjson.com': {
+        'rate_per_second': 5,
+        'burst': 10,
+        'processes': len(API_URLS)
+    },
+    'storage.googleapis.com': {
+        'rate_per_second': 50,
+        'burst': 100,
+        'hedge_after_seconds': 5.0
+    }
+}
+
+# Memory budget per worker process. Fetch pages, transform chunks and load row groups are
+# sized from the measured bytes per record so each stage stays under the budget.
+MEMORY_BUDGET_CONFIG = {
+    'budget_mb': int(os.environ.get('PIPELINE_MEMORY_BUDGET_MB', 1024)),
+    'chunk_headroom': 0.25,
+    'default_bytes_per_record': 8192,
+    'min_chunk_records': 50,
+    'max_chunk_records': 100000,
+    'sample_interval_seconds': 0.05
+}
+
+# Continuous micro-batch mode (seconds unless stated otherwise)
+MICRO_BATCH_CONFIG = {
+    'poll_interval_seconds': 30,
+    'batch_size': 500,
+    'commit_interval_seconds': 60,
+    'compaction_interval_seconds': 900,
+    'stream_retention_days': 2
+}
+
+# Mergeable sketches (HyperLogLog distinct buyers, t-digest quantiles) kept in GCS
+# and folded in per transformed carts batch, so report refreshes never rescan carts_table
+SKETCH_CONFIG = {
+    'path': 'sketches/carts_sketches.json',
+    'hll_precision': 12,
+    'tdigest_compression': 200,
+    'quantiles': [0.5, 0.9, 0.99],
+    'write_attempts': 3
+}
+
+# Local disk cache of immutable raw GCS blobs (keyed by generation and checksum, LRU by size).
+# Blobs above the threshold are downloaded as parallel byte ranges.
+RAW_CACHE_CONFIG = {
+    'directory': os.environ.get('PIPELINE_RAW_CACHE_DIR', '/opt/airflow/data/raw_cache'),
+    'max_bytes': int(os.environ.get('PIPELINE_RAW_CACHE_MB', 2048)) * 1024 * 1024,
+    'parallel_threshold_bytes': 16 * 1024 * 1024,
+    'range_bytes': 8 * 1024 * 1024,
+    'max_workers': 8
+}
+
+# Codec new raw snapshots are written with: json, orjson or msgpack, optionally with
+# +gzip or +zstd (e.g. "msgpack+zstd"). Readers detect the codec from blob metadata.
+RAW_CODEC = os.environ.get('PIPELINE_RAW_CODEC', 'json')
@@ -1,9 +1,14 @@
 # Import the necessary python packages
 from datetime import datetime, timedelta
 from airflow import DAG
+from airflow.exceptions import AirflowException, AirflowFailException
 from airflow.operators.python_operator import PythonOperator
 from airflow.operators.dummy_operator import DummyOperator
 from airflow.utils.dates import days_ago
+from airflow.utils.task_group import TaskGroup, task_group
+
+from bigquery_deferrable import BigQueryDeferrableOperator
+from config.gcp_config import API_URLS, GCP_PROJECT_ID, BQ_LOCATION, BQ_JOB_POLL_CONFIG
 
 default_args = {
     'owner': 'Augustine',
@@ -24,100 +29,187 @@ dag = DAG(
     tags=['savannah', 'etl', 'incremental'],
 )
 
+# Entities in map-index order of the entity_lane mapping (carts get their own lane)
+ENTITIES = [data_type for data_type in API_URLS if data_type != 'carts']
+
+# Snapshots the carts transform builds its product and user indexes from
+CART_DIMENSIONS = ['products', 'users']
+
 def setup_infrastructure_task():
     """Task to create BigQuery dataset and tables"""
     print("Setting up BigQuery infrastructure...")
-    import sys
-    sys.path.append('/opt/airflow/scripts')
     from scripts.load_data import create_bq_tables_if_not_exist
     create_bq_tables_if_not_exist()
     print("BigQuery infrastructure ready!")
 
-def extract_task():
-    """Task to extract data from APIs with incremental logic"""
-    print("Starting incremental data extraction from APIs...")
-    import sys
-    sys.path.append('/opt/airflow/scripts')
-    from scripts.extract_data import extract_all_data
-    return extract_all_data()
-
-def transform_task(**kwargs):
-    """Task to transform and clean data"""
-    print("Starting data transformation...")
+def extract_task(data_type):
+    """Task to extract one entity from its API with incremental logic"""
+    print(f"Starting incremental {data_type} extraction from API...")
+    from scripts.extract_data import extract_entity_data, update_metadata_robust
+    from scripts.memory_budget import print_memory_report
+    try:
+        return extract_entity_data(data_type)
+    except Exception:
+        update_metadata_robust(data_type, 'FAILED', 0, False)
+        raise
+    finally:
+        print_memory_report()
+
+def pull_lane_result(ti, task_id):
+    """XCom of a task in the same lane (task group and map index) as the running task"""
+    lane = ti.task_id.rsplit('.', 1)[0]
+    return ti.xcom_pull(task_ids=f"{lane}.{task_id}", map_indexes=ti.map_index)
+
+def pull_dimension_result(ti, data_type):
+    """This run's extraction result for a dimension entity, or None if its extract failed"""
+    if data_type not in ENTITIES:
+        return None
+    return ti.xcom_pull(task_ids='entity_lane.extract_data', map_indexes=ENTITIES.index(data_type))
+
+def transform_task(data_type, **kwargs):
+    """Task to transform and clean one entity"""
+    print(f"Starting {data_type} transformation...")
     ti = kwargs['ti']
-    extraction_results = ti.xcom_pull(task_ids='extract_data')
+    extraction_result = pull_lane_result(ti, 'extract_data')
+    if extraction_result is None:
+        # Retrying cannot help once the extract has failed
+        raise AirflowFailException(f"No {data_type} extraction result in this run")
+    
+    # Carts are enriched from this run's products and users snapshots
+    dimension_paths = {}
+    if data_type == 'carts':
+        for dimension in CART_DIMENSIONS:
+            dimension_result = pull_dimension_result(ti, dimension)
+            if dimension_result is not None:
+                dimension_paths[dimension] = dimension_result['gcs_path']
+            else:
+                print(f"No {dimension} extraction in this run, falling back to the latest {dimension} snapshot")
     
-    import sys
-    sys.path.append('/opt/airflow/scripts')
-    from scripts.transform_data import transform_all_data
+    from scripts.memory_budget import print_memory_report
+    from scripts.transform_data import transform_entity_data
     
-    return transform_all_data(extraction_results)
+    try:
+        return transform_entity_data(data_type, extraction_result, dimension_paths=dimension_paths)
+    finally:
+        print_memory_report()
 
-def load_task(**kwargs):
-    """Task to load data to BigQuery using incremental MERGE"""
-    print("Starting incremental data loading to BigQuery...")
+def submit_load_task(data_type, previous_job_ids, **kwargs):
+    """Task step to submit one entity's BigQuery load job (waited on by the triggerer)"""
+    print(f"Submitting incremental {data_type} load to BigQuery...")
     ti = kwargs['ti']
-    transformed_data = ti.xcom_pull(task_ids='transform_data')
+    transformed_df = pull_lane_result(ti, 'transform_data')
     
-    import sys
-    sys.path.append('/opt/airflow/scripts')
-    from scripts.load_data import load_incremental_data
+    from scripts.load_data import submit_entity_load
+    from scripts.memory_budget import print_memory_report
     
-    load_results = load_incremental_data(transformed_data)
-    print("Data loaded to BigQuery using incremental MERGE!")
-    return load_results
+    try:
+        return submit_entity_load(data_type, transformed_df)
+    finally:
+        print_memory_report()
 
-def analyze_task():
-    """Task to run analysis queries"""
+def submit_merge_task(data_type, previous_job_ids, **kwargs):
+    """Task step to submit the staging MERGE once the staging load has finished"""
+    from scripts.load_data import submit_entity_merge
+    
+    return submit_entity_merge(data_type, previous_job_ids)
+
+def submit_analyses_task(previous_job_ids, **kwargs):
+    """Task step to submit the analysis queries (waited on by the triggerer)"""
     print("Starting data analysis...")
-    import sys
-    sys.path.append('/opt/airflow/scripts')
-    from scripts.queries import run_all_analyses
-    run_all_analyses()
-    print("Analysis completed successfully")
-
-# Define tasks
-start_pipeline = DummyOperator(
-    task_id='start_pipeline',
-    dag=dag,
-)
+    from scripts.queries import submit_all_analyses
+    return submit_all_analyses()
 
-setup_infrastructure = PythonOperator(
-    task_id='setup_infrastructure',
-    python_callable=setup_infrastructure_task,
-    dag=dag,
-)
+def verify_run_task(**kwargs):
+    """Fail the run if any lane (or the analysis) failed, once analysis has run on what did load"""
+    ti = kwargs['ti']
+    failed = [
+        task_instance.task_id if task_instance.map_index < 0 else f"{task_instance.task_id}[{task_instance.map_index}]"
+        for task_instance in kwargs['dag_run'].get_task_instances(state=['failed', 'upstream_failed'])
+        if task_instance.task_id != ti.task_id
+    ]
+    if failed:
+        raise AirflowException(f"Pipeline tasks failed: {', '.join(sorted(failed))}")
+    print("All entity lanes and the analysis succeeded")
 
-extract_data = PythonOperator(
-    task_id='extract_data',
-    python_callable=extract_task,
-    dag=dag,
-)
+with dag:
+    # Define tasks
+    start_pipeline = DummyOperator(
+        task_id='start_pipeline',
+    )
 
-transform_data = PythonOperator(
-    task_id='transform_data',
-    python_callable=transform_task,
-    provide_context=True,
-    dag=dag,
-)
+    setup_infrastructure = PythonOperator(
+        task_id='setup_infrastructure',
+        python_callable=setup_infrastructure_task,
+    )
 
-load_data = PythonOperator(
-    task_id='load_data',
-    python_callable=load_task,
-    provide_context=True,
-    dag=dag,
-)
+    def lane_tasks(data_type, transform_trigger_rule='all_success'):
+        """Extract -> transform -> load tasks of one entity lane, created inside its task group"""
+        extract_data = PythonOperator(
+            task_id='extract_data',
+            python_callable=extract_task,
+            op_kwargs={'data_type': data_type},
+        )
 
-analyze_data = PythonOperator(
-    task_id='analyze_data',
-    python_callable=analyze_task,
-    dag=dag,
-)
+        transform_data = PythonOperator(
+            task_id='transform_data',
+            python_callable=transform_task,
+            op_kwargs={'data_type': data_type},
+            trigger_rule=transform_trigger_rule,
+        )
 
-end_pipeline = DummyOperator(
-    task_id='end_pipeline',
-    dag=dag,
-)
+        load_data = BigQueryDeferrableOperator(
+            task_id='load_data',
+            submit_callables=[submit_load_task, submit_merge_task],
+            op_kwargs={'data_type': data_type},
+            project_id=GCP_PROJECT_ID,
+            location=BQ_LOCATION,
+            **BQ_JOB_POLL_CONFIG,
+        )
+
+        extract_data >> transform_data >> load_data
+        return transform_data
+
+    @task_group(group_id='entity_lane')
+    def entity_lane(data_type):
+        """One extract -> transform -> load lane per entity, retried independently"""
+        lane_tasks(data_type)
+
+    # Dynamic task mapping: one parallel lane per dimension entity in API_URLS
+    entity_lanes = entity_lane.expand(data_type=ENTITIES)
+
+    with TaskGroup(group_id='carts_lane') as carts_lane:
+        # Runs when a products or users extract failed too, falling back to the latest snapshot
+        carts_transform = lane_tasks('carts', transform_trigger_rule='all_done')
+
+    # Only the carts transform waits for the products and users extracts (this run's snapshots);
+    # the other lanes never wait on carts
+    dag.get_task('entity_lane.extract_data') >> carts_transform
+
+    # Fan-in: analysis runs once every lane has finished, even if one entity failed
+    lanes_complete = DummyOperator(
+        task_id='lanes_complete',
+        trigger_rule='all_done',
+    )
+
+    analyze_data = BigQueryDeferrableOperator(
+        task_id='analyze_data',
+        submit_callables=[submit_analyses_task],
+        project_id=GCP_PROJECT_ID,
+        location=BQ_LOCATION,
+        **BQ_JOB_POLL_CONFIG,
+    )
+
+    # Runs whatever happened upstream, so a failed lane still fails the DAG run
+    verify_run = PythonOperator(
+        task_id='verify_run',
+        python_callable=verify_run_task,
+        trigger_rule='all_done',
+    )
+
+    end_pipeline = DummyOperator(
+        task_id='end_pipeline',
+    )
 
-# Define task dependencies - infrastructure first!
-start_pipeline >> setup_infrastructure >> extract_data >> transform_data >> load_data >> analyze_data >> end_pipeline
\ No newline at end of file
+    # Define task dependencies - infrastructure first, then the entity lanes in parallel!
+    start_pipeline >> setup_infrastructure >> [entity_lanes, carts_lane] >> lanes_complete >> analyze_data
+    [entity_lanes, carts_lane, analyze_data] >> verify_run >> end_pipeline
@@ -0,0 +1,37 @@
+# Import the necessary python packages
+from datetime import timedelta
+from airflow import DAG
+from airflow.operators.python_operator import PythonOperator
+from airflow.utils.dates import days_ago
+
+default_args = {
+    'owner': 'Augustine',
+    'depends_on_past': False,
+    'start_date': days_ago(1),
+    'email_on_failure': False,
+    'email_on_retry': False,
+    'retries': 2,
+    'retry_delay': timedelta(minutes=3),
+}
+
+dag = DAG(
+    'savannah_raw_lake_compaction',
+    default_args=default_args,
+    description='Daily compaction of raw JSON snapshots into date-partitioned Parquet',
+    schedule_interval='@daily',
+    catchup=False,
+    tags=['savannah', 'data-lake', 'compaction'],
+)
+
+def compact_task(**kwargs):
+    """Task to compact the previous day's raw snapshots into Parquet and update the manifest"""
+    from scripts.compact_raw import compact_all_data
+    start = kwargs['data_interval_start'].replace(tzinfo=None)
+    end = kwargs['data_interval_end'].replace(tzinfo=None)
+    return compact_all_data(start, end)
+
+compact_raw_lake = PythonOperator(
+    task_id='compact_raw_lake',
+    python_callable=compact_task,
+    dag=dag,
+)
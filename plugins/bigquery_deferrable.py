@@ -0,0 +1,129 @@
+# Deferrable BigQuery job waiting: tasks submit jobs, the triggerer waits on them
+import asyncio
+from functools import partial
+
+from airflow.exceptions import AirflowException
+from airflow.models import BaseOperator
+from airflow.triggers.base import BaseTrigger, TriggerEvent
+
+# One BigQuery client per project, shared by every trigger running in the triggerer process
+_CLIENTS = {}
+
+def _get_client(project_id):
+    """Get (or create) the shared BigQuery client for a project"""
+    if project_id not in _CLIENTS:
+        from google.cloud import bigquery
+        _CLIENTS[project_id] = bigquery.Client(project=project_id)
+    return _CLIENTS[project_id]
+
+class BigQueryJobsTrigger(BaseTrigger):
+    """Async waiter that polls a set of BigQuery jobs with backoff until all are DONE"""
+
+    def __init__(self, job_ids, project_id, location=None, poll_interval=5.0,
+                 max_poll_interval=60.0, backoff_factor=1.5):
+        super().__init__()
+        self.job_ids = list(job_ids)
+        self.project_id = project_id
+        self.location = location
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.backoff_factor = backoff_factor
+
+    def serialize(self):
+        return (
+            "bigquery_deferrable.BigQueryJobsTrigger",
+            {
+                'job_ids': self.job_ids,
+                'project_id': self.project_id,
+                'location': self.location,
+                'poll_interval': self.poll_interval,
+                'max_poll_interval': self.max_poll_interval,
+                'backoff_factor': self.backoff_factor,
+            },
+        )
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        client = _get_client(self.project_id)
+        pending = list(self.job_ids)
+        interval = self.poll_interval
+
+        while pending:
+            for job_id in list(pending):
+                # The BigQuery client is synchronous, so run the status call off the event loop
+                job = await loop.run_in_executor(
+                    None, partial(client.get_job, job_id, project=self.project_id, location=self.location)
+                )
+                if job.state != 'DONE':
+                    continue
+
+                pending.remove(job_id)
+                if job.error_result:
+                    yield TriggerEvent({
+                        'status': 'error',
+                        'job_id': job_id,
+                        'message': job.error_result.get('message', str(job.error_result)),
+                    })
+                    return
+
+            if pending:
+                self.log.info("Waiting on %d BigQuery job(s), next poll in %.1fs", len(pending), interval)
+                await asyncio.sleep(interval)
+                interval = min(interval * self.backoff_factor, self.max_poll_interval)
+
+        yield TriggerEvent({'status': 'success', 'job_ids': self.job_ids})
+
+class BigQueryDeferrableOperator(BaseOperator):
+    """Run submit steps that return BigQuery job IDs, deferring to the triggerer between steps
+
+    Each callable in ``submit_callables`` receives the task context, ``op_kwargs`` and the
+    ``previous_job_ids`` of the step before it, and returns the job IDs it submitted.
+    """
+
+    template_fields = ('op_kwargs',)
+
+    def __init__(self, *, submit_callables, project_id, location=None, op_kwargs=None,
+                 poll_interval=5.0, max_poll_interval=60.0, backoff_factor=1.5, **kwargs):
+        super().__init__(**kwargs)
+        self.submit_callables = submit_callables
+        self.project_id = project_id
+        self.location = location
+        self.op_kwargs = op_kwargs or {}
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.backoff_factor = backoff_factor
+
+    def execute(self, context):
+        return self._submit_from(context, step=0, previous_job_ids=[])
+
+    def execute_complete(self, context, event, step):
+        if event['status'] != 'success':
+            raise AirflowException(f"BigQuery job {event['job_id']} failed: {event['message']}")
+        self.log.info("BigQuery job(s) finished: %s", event['job_ids'])
+        return self._submit_from(context, step=step + 1, previous_job_ids=event['job_ids'])
+
+    def _submit_from(self, context, step, previous_job_ids):
+        while step < len(self.submit_callables):
+            job_ids = [
+                job_id for job_id in self.submit_callables[step](
+                    previous_job_ids=previous_job_ids, **self.op_kwargs, **context
+                ) or []
+                if job_id
+            ]
+            if job_ids:
+                # Frees the worker slot until the triggerer reports the jobs as DONE
+                self.defer(
+                    trigger=BigQueryJobsTrigger(
+                        job_ids=job_ids,
+                        project_id=self.project_id,
+                        location=self.location,
+                        poll_interval=self.poll_interval,
+                        max_poll_interval=self.max_poll_interval,
+                        backoff_factor=self.backoff_factor,
+                    ),
+                    method_name='execute_complete',
+                    kwargs={'step': step},
+                )
+            previous_job_ids = job_ids
+            step += 1
+        return previous_job_ids
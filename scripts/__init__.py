@@ -0,0 +1 @@
+# ETL scripts for the Savannah pipeline
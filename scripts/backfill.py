@@ -0,0 +1,253 @@
+# Historical backfill / replay of the warehouse from the raw data lake snapshots
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+from config.gcp_config import API_URLS, BACKFILL_CONFIG
+from scripts.lazy_imports import lazy_import
+from scripts.memory_budget import print_memory_report
+from scripts.load_data import (
+    TABLE_MAPPING,
+    create_bq_tables_if_not_exist,
+    load_direct_insert,
+    load_to_staging,
+    merge_from_staging,
+)
+from scripts.raw_cache import cache_stats
+from scripts.compact_raw import SNAPSHOT_TS_COLUMN, read_compacted_file
+from scripts.raw_lake import list_raw_snapshots, read_manifest, select_manifest_files
+from scripts.sketches import rebuild_cart_sketches, update_cart_sketches
+from scripts.validate_data import validate_and_quarantine
+from scripts.transform_data import (
+    encode_categoricals,
+    load_json_from_gcs,
+    load_dimension_index,
+    lookup_dimension,
+    transform_carts_data,
+    transform_products_data,
+    transform_users_data,
+)
+
+pd = lazy_import('pandas')
+storage = lazy_import('google.cloud.storage')
+
+TRANSFORMS = {
+    'users': transform_users_data,
+    'products': transform_products_data,
+    'carts': transform_carts_data,
+}
+
+# Helper column used to keep the latest version of each record across snapshots
+SNAPSHOT_SEQ_COLUMN = '_snapshot_seq'
+
+def transform_records(data_type, raw_data, product_index=None):
+    """Transform one snapshot's records with no max-ID filter, enriching carts from the product index"""
+    if data_type == 'carts':
+        return transform_carts_data(raw_data, 0, product_index)
+    return TRANSFORMS[data_type](raw_data, 0)
+
+def transform_snapshot(data_type, snapshot, client, start=None, end=None, product_index=None):
+    """Download and transform a single raw snapshot (all records, no max-ID filter)"""
+    raw_data = load_json_from_gcs(snapshot['gcs_path'], client=client)
+    return [transform_records(data_type, raw_data, product_index)]
+
+def transform_compacted_file(data_type, entry, client, start=None, end=None, product_index=None):
+    """Read a compacted day file and transform each snapshot it holds, oldest first"""
+    records_by_snapshot = {}
+    for record in read_compacted_file(entry['path'], client).to_pylist():
+        snapshot_ts = record[SNAPSHOT_TS_COLUMN]
+        # Compacted files cover whole days, so drop snapshots outside the requested range
+        if (start is not None and snapshot_ts < start) or (end is not None and snapshot_ts >= end):
+            continue
+        records_by_snapshot.setdefault(snapshot_ts, []).append(record)
+
+    return [
+        transform_records(data_type, {data_type: records}, product_index)
+        for _, records in sorted(records_by_snapshot.items())
+    ]
+
+def list_backfill_sources(data_type, start, end, source, client):
+    """Units of backfill work in chronological order: raw JSON snapshots, or compacted files selected via the manifest
+
+    Compacted replays also take the raw snapshots no compacted file holds (taken after the
+    last compaction, or on days whose compaction failed), so nothing in the range is dropped.
+    """
+    raw_snapshots = list_raw_snapshots(data_type, start, end, client=client)
+    if source != 'compacted':
+        return [
+            {'name': snapshot['name'], 'size': snapshot['size'], 'item': snapshot, 'transform': transform_snapshot}
+            for snapshot in raw_snapshots
+        ]
+
+    manifest, _ = read_manifest(data_type, client)
+    compacted_blobs = {name for entry in manifest['files'] for name in entry.get('source_blobs', [])}
+    units = [
+        {'name': entry['path'], 'size': entry['bytes'], 'item': entry, 'transform': transform_compacted_file,
+         'timestamp': datetime.fromisoformat(entry['min_snapshot_ts'])}
+        for entry in select_manifest_files(manifest, start, end)
+    ]
+    uncompacted = [snapshot for snapshot in raw_snapshots if snapshot['name'] not in compacted_blobs]
+    if uncompacted:
+        print(f"{len(uncompacted)} {data_type} snapshots are not compacted yet, replaying them from the raw JSON")
+    units += [
+        {'name': snapshot['name'], 'size': snapshot['size'], 'item': snapshot, 'transform': transform_snapshot,
+         'timestamp': snapshot['timestamp']}
+        for snapshot in uncompacted
+    ]
+    return sorted(units, key=lambda unit: unit['timestamp'])
+
+def keep_latest_records(frames, merge_key):
+    """Combine per-snapshot frames, keeping each key from the most recent snapshot only"""
+    tagged = [
+        df.assign(**{SNAPSHOT_SEQ_COLUMN: seq})
+        for seq, df in enumerate(frames)
+        if df is not None and not df.empty
+    ]
+    if not tagged:
+        return pd.DataFrame()
+
+    combined = pd.concat(tagged, ignore_index=True)
+    # Carts explode into one row per product, so keep every row of the latest snapshot per key
+    latest_seq = combined.groupby(merge_key)[SNAPSHOT_SEQ_COLUMN].transform('max')
+    latest = combined[combined[SNAPSHOT_SEQ_COLUMN] == latest_seq]
+    return latest.drop(columns=[SNAPSHOT_SEQ_COLUMN]).reset_index(drop=True)
+
+def refresh_cart_sketches(df, end, rebuild):
+    """Bring the cart sketches in line with a carts backfill
+
+    Rebuilding replaces the stored state with sketches of the replayed frame. Otherwise only
+    carts above the state's max_cart_id are folded in (every cart if the state was lost).
+    """
+    user_index = load_dimension_index('users', before=end)
+    cities = lookup_dimension(user_index, df['user_id'], 'city')
+    if rebuild:
+        return rebuild_cart_sketches(df, cities)
+    return update_cart_sketches(df, cities)
+
+def backfill_entity(data_type, start=None, end=None, max_workers=None, replace=False, source='raw',
+                    rebuild_sketches=False):
+    """Replay all snapshots of an entity in [start, end) and bulk-load the result"""
+    max_workers = max_workers or BACKFILL_CONFIG['max_workers']
+    config = TABLE_MAPPING[data_type]
+
+    print(f"\n{'='*50}")
+    print(f" BACKFILL: {data_type}")
+    print(f"{'='*50}")
+
+    client = storage.Client()
+
+    sources = list_backfill_sources(data_type, start, end, source, client)
+    if not sources:
+        print(f"No {source} {data_type} snapshots found in the requested range")
+        return {'snapshots': 0, 'records': 0, 'bytes': 0, 'seconds': 0.0}
+
+    total_bytes = sum(unit['size'] for unit in sources)
+    print(f"Found {len(sources)} {source} sources ({total_bytes / 1e6:.1f} MB)")
+
+    # Carts are enriched from the catalog as of the end of the range
+    product_index = load_dimension_index('products', before=end) if data_type == 'carts' else None
+
+    started = time.monotonic()
+    results = [None] * len(sources)
+    done_bytes = 0
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(unit['transform'], data_type, unit['item'], client, start, end, product_index): index
+            for index, unit in enumerate(sources)
+        }
+        for done, future in enumerate(as_completed(futures), start=1):
+            index = futures[future]
+            results[index] = future.result()
+            done_bytes += sources[index]['size']
+
+            elapsed = max(time.monotonic() - started, 1e-9)
+            rows = sum(len(frame) for frame in results[index])
+            print(f"[{done}/{len(sources)}] {sources[index]['name']}: {rows} rows "
+                  f"| {done / elapsed:.1f} sources/s, {done_bytes / 1e6 / elapsed:.2f} MB/s")
+
+    # frames are in chronological order, so the highest sequence number is the latest version
+    frames = [frame for frames in results for frame in frames]
+    df = validate_and_quarantine(keep_latest_records(frames, config['merge_key']), data_type)
+    if df is not None and not df.empty:
+        df = encode_categoricals(df, data_type)
+
+    # A single load job per table instead of one MERGE per snapshot
+    if df.empty:
+        records_loaded = 0
+    elif replace:
+        records_loaded = load_direct_insert(df, config['target'])
+    else:
+        records_loaded = load_to_staging(df, config['staging'])
+        merge_from_staging(config['target'], config['staging'], config['row_keys'])
+
+    # A replaced carts_table holds exactly the replayed carts, so its sketches are rebuilt too
+    if data_type == 'carts' and not df.empty:
+        refresh_cart_sketches(df, end, rebuild=replace or rebuild_sketches)
+
+    elapsed = max(time.monotonic() - started, 1e-9)
+    print(f"Backfilled {records_loaded} {data_type} records from {len(frames)} snapshots "
+          f"in {elapsed:.1f}s ({len(df) / elapsed:.0f} records/s, {total_bytes / 1e6 / elapsed:.2f} MB/s)")
+
+    return {
+        'snapshots': len(frames),
+        'records': records_loaded,
+        'bytes': total_bytes,
+        'seconds': elapsed,
+    }
+
+def backfill_all_data(start=None, end=None, data_types=None, max_workers=None, replace=False, source='raw',
+                      rebuild_sketches=False):
+    """Backfill every entity from the raw data lake"""
+    print(" STARTING BACKFILL FROM RAW DATA LAKE")
+    create_bq_tables_if_not_exist()
+
+    results = {}
+    for data_type in data_types or list(API_URLS):
+        try:
+            results[data_type] = backfill_entity(data_type, start, end, max_workers, replace, source, rebuild_sketches)
+        except Exception as e:
+            print(f"Failed to backfill {data_type} data: {e}")
+            results[data_type] = {'error': str(e)}
+
+    print("\n" + "="*50)
+    print("BACKFILL SUMMARY")
+    print("="*50)
+    for data_type, result in results.items():
+        if 'error' in result:
+            print(f"  {data_type}: FAILED ({result['error']})")
+        else:
+            print(f"  {data_type}: {result['records']} records from {result['snapshots']} snapshots "
+                  f"in {result['seconds']:.1f}s")
+    print_memory_report()
+    print(f"Raw cache: {cache_stats()}")
+    print("="*50)
+
+    return results
+
+def parse_datetime(value):
+    """Parse a YYYY-MM-DD or YYYYmmdd_HHMMSS command-line timestamp"""
+    for fmt in ("%Y-%m-%d", "%Y%m%d_%H%M%S", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError(f"Invalid timestamp: {value}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the warehouse from raw GCS snapshots")
+    parser.add_argument('--start', type=parse_datetime, help="First snapshot time (inclusive)")
+    parser.add_argument('--end', type=parse_datetime, help="Last snapshot time (exclusive)")
+    parser.add_argument('--entities', nargs='+', choices=list(API_URLS), help="Entities to backfill")
+    parser.add_argument('--workers', type=int, default=BACKFILL_CONFIG['max_workers'])
+    parser.add_argument('--replace', action='store_true',
+                        help="Truncate the clean tables instead of merging into them")
+    parser.add_argument('--source', choices=['raw', 'compacted'], default='raw',
+                        help="Replay raw JSON snapshots or the compacted Parquet files listed in the manifest")
+    parser.add_argument('--rebuild-sketches', action='store_true',
+                        help="Rebuild the cart sketches from the replayed carts (implied by --replace)")
+    args = parser.parse_args()
+
+    backfill_all_data(args.start, args.end, args.entities, args.workers, args.replace, args.source,
+                      args.rebuild_sketches)
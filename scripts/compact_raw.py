@@ -0,0 +1,145 @@
+# Compaction of the raw JSON snapshots into date-partitioned Parquet with a manifest
+import argparse
+import io
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from config.gcp_config import API_URLS, COMPACTION_CONFIG, GCS_BUCKET_NAME
+from scripts.lazy_imports import lazy_import
+from scripts.raw_lake import (
+    compacted_file_name,
+    list_raw_snapshots,
+    read_manifest,
+    write_manifest,
+)
+from scripts.transform_data import load_json_from_gcs
+
+pa = lazy_import('pyarrow')
+pq = lazy_import('pyarrow.parquet')
+storage = lazy_import('google.cloud.storage')
+
+# Columns added to every compacted row to record where it came from
+SNAPSHOT_TS_COLUMN = '_snapshot_ts'
+SNAPSHOT_KIND_COLUMN = '_snapshot_kind'
+
+def day_bounds(start, end):
+    """Widen [start, end) to whole days, since each compacted file covers one day"""
+    start_day = datetime.combine(start.date(), datetime.min.time())
+    end_day = datetime.combine(end.date(), datetime.min.time())
+    if end_day < end:
+        end_day += timedelta(days=1)
+    return start_day, end_day
+
+def rows_to_table(rows):
+    """Arrow table over the union of the rows' keys, each column typed from all of its values
+
+    pa.Table.from_pylist takes the top-level columns from the first row only, so a
+    field missing from the first record would be dropped for the whole file.
+    """
+    columns = list(dict.fromkeys(key for row in rows for key in row))
+    return pa.Table.from_pydict({column: [row.get(column) for row in rows] for column in columns})
+
+def compact_day(data_type, date, snapshots, client):
+    """Merge one day's JSON snapshots into a single compressed Parquet file; returns its manifest entry"""
+    rows = []
+    for snapshot in snapshots:
+        raw_data = load_json_from_gcs(snapshot['gcs_path'], client=client)
+        for record in raw_data.get(data_type, []):
+            rows.append({
+                **record,
+                SNAPSHOT_TS_COLUMN: snapshot['timestamp'],
+                SNAPSHOT_KIND_COLUMN: snapshot['kind'],
+            })
+
+    table = rows_to_table(rows)
+    buffer = io.BytesIO()
+    pq.write_table(table, buffer, compression=COMPACTION_CONFIG['compression'])
+
+    blob_name = compacted_file_name(data_type, date)
+    client.bucket(GCS_BUCKET_NAME).blob(blob_name).upload_from_string(
+        buffer.getvalue(), content_type='application/octet-stream'
+    )
+
+    ids = [row['id'] for row in rows if row.get('id') is not None]
+    entry = {
+        'path': f"gs://{GCS_BUCKET_NAME}/{blob_name}",
+        'date': date.isoformat(),
+        'row_count': table.num_rows,
+        'snapshot_count': len(snapshots),
+        'bytes': buffer.tell(),
+        'source_bytes': sum(snapshot['size'] for snapshot in snapshots),
+        'min_id': min(ids) if ids else None,
+        'max_id': max(ids) if ids else None,
+        'min_snapshot_ts': snapshots[0]['timestamp'].isoformat(),
+        'max_snapshot_ts': snapshots[-1]['timestamp'].isoformat(),
+        'source_blobs': [snapshot['name'] for snapshot in snapshots],
+        'compacted_at': datetime.now().isoformat(),
+    }
+
+    print(f"Compacted {len(snapshots)} {data_type} snapshots for {date} into {blob_name}: "
+          f"{entry['row_count']} rows, {entry['source_bytes'] / 1e6:.2f} MB -> {entry['bytes'] / 1e6:.2f} MB")
+    return entry
+
+def compact_entity(data_type, start, end, client=None):
+    """Compact all snapshots of an entity in [start, end) (widened to whole days)"""
+    client = client or storage.Client()
+    start, end = day_bounds(start, end)
+
+    snapshots = list_raw_snapshots(data_type, start, end, client=client)
+    if not snapshots:
+        print(f"No raw {data_type} snapshots to compact between {start} and {end}")
+        return []
+
+    by_day = defaultdict(list)
+    for snapshot in snapshots:
+        by_day[snapshot['timestamp'].date()].append(snapshot)
+
+    entries = [compact_day(data_type, date, day_snapshots, client) for date, day_snapshots in sorted(by_day.items())]
+
+    # Each day's file is rebuilt from all of that day's snapshots, so its entry replaces any older one
+    manifest, generation = read_manifest(data_type, client)
+    compacted_dates = {entry['date'] for entry in entries}
+    manifest['files'] = sorted(
+        [entry for entry in manifest['files'] if entry['date'] not in compacted_dates] + entries,
+        key=lambda entry: entry['date'],
+    )
+    manifest['updated_at'] = datetime.now().isoformat()
+    write_manifest(data_type, manifest, generation, client)
+
+    return entries
+
+def compact_all_data(start, end, data_types=None):
+    """Compact the raw snapshots of every entity in [start, end)"""
+    print(f" COMPACTING RAW DATA LAKE: {start} -> {end}")
+    client = storage.Client()
+
+    results = {}
+    for data_type in data_types or list(API_URLS):
+        try:
+            entries = compact_entity(data_type, start, end, client)
+            results[data_type] = {
+                'files': len(entries),
+                'snapshots': sum(entry['snapshot_count'] for entry in entries),
+                'rows': sum(entry['row_count'] for entry in entries),
+            }
+        except Exception as e:
+            print(f"Failed to compact {data_type} data: {e}")
+            results[data_type] = {'error': str(e)}
+
+    return results
+
+def read_compacted_file(gcs_path, client=None):
+    """Read a compacted Parquet file from GCS into an Arrow table"""
+    client = client or storage.Client()
+    bucket_name, blob_path = gcs_path.replace("gs://", "").split("/", 1)
+    data = client.bucket(bucket_name).blob(blob_path).download_as_bytes()
+    return pq.read_table(pa.BufferReader(data))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compact raw JSON snapshots into date-partitioned Parquet")
+    parser.add_argument('--start', type=datetime.fromisoformat, required=True, help="YYYY-MM-DD (inclusive)")
+    parser.add_argument('--end', type=datetime.fromisoformat, required=True, help="YYYY-MM-DD (exclusive)")
+    parser.add_argument('--entities', nargs='+', choices=list(API_URLS), help="Entities to compact")
+    args = parser.parse_args()
+
+    compact_all_data(args.start, args.end, args.entities)
@@ -1,21 +1,25 @@
-# Import the critical python packages
-import requests
-import json
-import pandas as pd
+# Import the critical python packages (heavy ones are loaded lazily on first use)
+import tempfile
 from datetime import datetime, timedelta
-from google.cloud import storage, bigquery
-from google.api_core.exceptions import NotFound
+from urllib.parse import urlparse
 
-# Import configuration
-try:
-    from config.gcp_config import *
-except ImportError:
-    import sys
-    import os
-    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    if project_root not in sys.path:
-        sys.path.append(project_root)
-    from config.gcp_config import *
+from config.gcp_config import (
+    API_URLS,
+    BQ_DATASET,
+    BQ_METADATA_TABLE,
+    GCP_PROJECT_ID,
+    GCS_BUCKET_NAME,
+    RAW_CODEC,
+)
+from scripts import raw_codecs
+from scripts.io_control import GCS_HOST, get_io_controller
+from scripts.lazy_imports import lazy_import
+from scripts.memory_budget import chunk_size, print_memory_report, track_stage
+
+requests = lazy_import('requests')
+storage = lazy_import('google.cloud.storage')
+bigquery = lazy_import('google.cloud.bigquery')
+google_exceptions = lazy_import('google.api_core.exceptions')
 
 def get_last_successful_run_robust(data_type):
     """Get last run timestamp with proper first-run handling"""
@@ -25,7 +29,7 @@ def get_last_successful_run_robust(data_type):
         # First, check if dataset exists
         try:
             client.get_dataset(BQ_DATASET)
-        except NotFound:
+        except google_exceptions.NotFound:
             print(f" Dataset {BQ_DATASET} doesn't exist - FIRST RUN DETECTED")
             return None  # This signals first run
         
@@ -49,7 +53,7 @@ def get_last_successful_run_robust(data_type):
                     print(f" No previous {data_type} runs found - FIRST RUN")
                     return None
                     
-        except NotFound:
+        except google_exceptions.NotFound:
             print(f" Metadata table doesn't exist - FIRST RUN")
             return None
         
@@ -57,53 +61,87 @@ def get_last_successful_run_robust(data_type):
         print(f" Error checking last run for {data_type}: {e}")
         return None
 
-def fetch_data_with_fallback(api_url, data_type, last_run_timestamp):
-    """Fetch data with incremental logic, but get all data on first run"""
+def get_json(api_url, timeout):
+    """GET a JSON document, raising on HTTP errors"""
+    response = requests.get(api_url, timeout=timeout)
+    response.raise_for_status()
+    return response.json()
+
+def iter_pages(controller, api_url, data_type):
+    """Yield each page of records of a DummyJSON collection (limit/skip), sizing pages from the memory budget"""
+    stage = f"extract_{data_type}"
+    fetched = 0
+    total = None
+    
+    while total is None or fetched < total:
+        page_size = chunk_size(stage)
+        with track_stage(stage) as tracker:
+            page = controller.call(
+                get_json, f"{api_url}?limit={page_size}&skip={fetched}", controller.config['timeout_seconds']
+            )
+            page_records = page.get(data_type, [])
+            tracker.records = len(page_records)
+        
+        if not page_records:
+            break
+        fetched += len(page_records)
+        total = page.get('total', fetched)
+        yield page_records
+
+def fetch_pages_with_fallback(api_url, data_type, last_run_timestamp):
+    """Yield pages of records with incremental logic, but all data on first run"""
+    controller = get_io_controller(urlparse(api_url).netloc)
     try:
         if last_run_timestamp is None:
             # FIRST RUN - Get all data
             print(f" FIRST RUN: Fetching ALL {data_type} data")
-            response = requests.get(api_url, timeout=30)
-            response.raise_for_status()
-            data = response.json()
+            yield from iter_pages(controller, api_url, data_type)
             
         else:
             # INCREMENTAL RUN - Get only new data (simulated for dummyjson)
             print(f" INCREMENTAL: Fetching {data_type} data since {last_run_timestamp}")
-            response = requests.get(api_url, timeout=30)
-            response.raise_for_status()
-            data = response.json()
+            yield from iter_pages(controller, api_url, data_type)
             
             # Since dummyjson doesn't support true incremental, we simulate it
             print(f" Note: DummyJSON doesn't support incremental APIs")
             print(f" In production, i'll filter by updatedAt > {last_run_timestamp}")
         
-        record_count = len(data.get(data_type, []))
-        print(f" Fetched {record_count} {data_type} records")
-        return data
-        
     except requests.exceptions.RequestException as e:
         print(f" Error fetching {data_type} data: {e}")
         raise
 
-def save_to_gcs_incremental(data, data_type, timestamp, is_first_run):
-    """Save data to GCS with appropriate naming"""
+def fetch_data_with_fallback(api_url, data_type, last_run_timestamp):
+    """Fetch data with incremental logic into one payload, for callers that need every record at once"""
+    records = [record for page in fetch_pages_with_fallback(api_url, data_type, last_run_timestamp) for record in page]
+    print(f" Fetched {len(records)} {data_type} records")
+    return {data_type: records, 'total': len(records), 'skip': 0, 'limit': len(records)}
+
+def save_to_gcs_incremental(snapshot, data_type, timestamp, is_first_run):
+    """Save a streamed snapshot (raw_codecs.SnapshotWriter) to GCS with appropriate naming"""
     try:
         client = storage.Client()
         bucket = client.bucket(GCS_BUCKET_NAME)
         
+        extension = raw_codecs.file_extension(snapshot.codec)
         if is_first_run:
             # First run - save as baseline
-            filename = f"raw_{data_type}/baseline_{timestamp}.json"
+            filename = f"raw_{data_type}/baseline_{timestamp}.{extension}"
         else:
             # Incremental run - save as incremental
-            filename = f"raw_{data_type}/incremental_{timestamp}.json"
+            filename = f"raw_{data_type}/incremental_{timestamp}.{extension}"
         
         blob = bucket.blob(filename)
-        json_data = json.dumps(data)
-        blob.upload_from_string(json_data, content_type='application/json')
+        # Readers pick the codec up from the metadata (no Content-Encoding, so GCS never transcodes)
+        blob.metadata = {raw_codecs.CODEC_METADATA_KEY: snapshot.codec}
+        with tempfile.TemporaryFile() as payload:
+            size = snapshot.finish(payload)
+            # Writes are retried but never hedged; rewind=True restarts every attempt from the first byte
+            get_io_controller(GCS_HOST).call(
+                blob.upload_from_file, payload, size=size, rewind=True,
+                content_type=raw_codecs.content_type(snapshot.codec), idempotent=False
+            )
         
-        print(f" Saved {filename} to GCS")
+        print(f" Saved {filename} to GCS ({size / 1e6:.2f} MB, codec {snapshot.codec})")
         return f"gs://{GCS_BUCKET_NAME}/{filename}"
         
     except Exception as e:
@@ -137,47 +175,60 @@ def update_metadata_robust(data_type, status, records_processed, is_first_run=Fa
         print(f" Could not update metadata for {data_type}: {e}")
         # Don't fail the pipeline if metadata update fails
 
+def extract_entity_data(data_type, timestamp=None):
+    """Extract a single entity with robust incremental logic"""
+    api_url = API_URLS[data_type]
+    if timestamp is None:
+        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+    
+    print(f"\n{'='*50}")
+    print(f" PROCESSING: {data_type}")
+    print(f"{'='*50}")
+    
+    # Get last successful run (returns None if first run)
+    last_run_timestamp = get_last_successful_run_robust(data_type)
+    is_first_run = (last_run_timestamp is None)
+    
+    # Fetch data (all data on first run, incremental on subsequent runs), streaming each
+    # page into the snapshot so only one page is held in memory
+    with raw_codecs.SnapshotWriter(data_type, RAW_CODEC) as snapshot:
+        for page in fetch_pages_with_fallback(api_url, data_type, last_run_timestamp):
+            snapshot.write(page)
+        record_count = snapshot.count
+        print(f" Fetched {record_count} {data_type} records")
+        
+        # Save to GCS
+        gcs_path = save_to_gcs_incremental(snapshot, data_type, timestamp, is_first_run)
+    
+    # Only the snapshot's path is returned (and pushed to XCom), never the records themselves
+    result = {
+        'gcs_path': gcs_path,
+        'record_count': record_count,
+        'timestamp': timestamp,
+        'last_run_timestamp': last_run_timestamp,
+        'is_first_run': is_first_run,
+    }
+    
+    # Update metadata
+    update_metadata_robust(data_type, 'EXTRACTED', record_count, is_first_run)
+    
+    print(f"{data_type} extraction completed: {record_count} records")
+    if is_first_run:
+        print(f"FIRST RUN - loaded all data as baseline")
+    else:
+        print(f"INCREMENTAL - loaded data since {last_run_timestamp}")
+    
+    return result
+
 def extract_all_data():
     """Main extraction function with robust incremental logic"""
     print(" STARTING EXTRACTION WITH ROBUST INCREMENTAL LOGIC")
     timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
     results = {}
     
-    for data_type, api_url in API_URLS.items():
+    for data_type in API_URLS:
         try:
-            print(f"\n{'='*50}")
-            print(f" PROCESSING: {data_type}")
-            print(f"{'='*50}")
-            
-            # Get last successful run (returns None if first run)
-            last_run_timestamp = get_last_successful_run_robust(data_type)
-            is_first_run = (last_run_timestamp is None)
-            
-            # Fetch data (all data on first run, incremental on subsequent runs)
-            data = fetch_data_with_fallback(api_url, data_type, last_run_timestamp)
-            
-            # Save to GCS
-            gcs_path = save_to_gcs_incremental(data, data_type, timestamp, is_first_run)
-            
-            record_count = len(data.get(data_type, []))
-            
-            results[data_type] = {
-                'gcs_path': gcs_path,
-                'record_count': record_count,
-                'timestamp': timestamp,
-                'last_run_timestamp': last_run_timestamp,
-                'is_first_run': is_first_run,
-                'data': data
-            }
-            
-            # Update metadata
-            update_metadata_robust(data_type, 'EXTRACTED', record_count, is_first_run)
-            
-            print(f"{data_type} extraction completed: {record_count} records")
-            if is_first_run:
-                print(f"FIRST RUN - loaded all data as baseline")
-            else:
-                print(f"INCREMENTAL - loaded data since {last_run_timestamp}")
+            results[data_type] = extract_entity_data(data_type, timestamp)
             
         except Exception as e:
             print(f"Failed to extract {data_type} data: {e}")
@@ -185,6 +236,7 @@ def extract_all_data():
             update_metadata_robust(data_type, 'FAILED', 0, False)
     
     print(f"\n EXTRACTION COMPLETED")
+    print_memory_report()
     return results
 
 if __name__ == "__main__":
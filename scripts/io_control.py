@@ -0,0 +1,218 @@
+# Shared I/O control for API and GCS calls: rate limiting, adaptive concurrency, backoff and hedging
+import random
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from config.gcp_config import IO_CONTROL_CONFIG
+
+# Host the GCS client talks to, so every GCS call shares one controller
+GCS_HOST = 'storage.googleapis.com'
+
+# HTTP statuses worth retrying; 429 and 503 also mean the server is throttling us
+RETRYABLE_STATUSES = {408, 429, 500, 502, 503, 504}
+THROTTLE_STATUSES = {429, 503}
+
+class TokenBucket:
+    """Token-bucket rate limiter: `rate` tokens per second with bursts of up to `capacity`"""
+
+    def __init__(self, rate, capacity):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Block until `tokens` tokens are available, then take them"""
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait_seconds = (tokens - self.tokens) / self.rate
+            time.sleep(wait_seconds)
+
+class AdaptiveConcurrencyLimiter:
+    """AIMD concurrency limit: grows additively on fast successes, shrinks multiplicatively
+    on errors, throttling or latency above the target"""
+
+    def __init__(self, initial, minimum, maximum, target_latency, decrease_factor=0.5,
+                 latency_decrease_factor=0.9):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.target_latency = target_latency
+        self.decrease_factor = decrease_factor
+        self.latency_decrease_factor = latency_decrease_factor
+        self.in_flight = 0
+        self.last_decrease = 0.0
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency, ok, throttled=False):
+        with self.condition:
+            self.in_flight -= 1
+            now = time.monotonic()
+            # Decrease at most once per latency window, so one burst of failures counts once
+            can_decrease = now - self.last_decrease >= self.target_latency
+            if throttled or not ok:
+                if can_decrease:
+                    self.limit = max(self.minimum, self.limit * self.decrease_factor)
+                    self.last_decrease = now
+            elif latency > self.target_latency:
+                if can_decrease:
+                    self.limit = max(self.minimum, self.limit * self.latency_decrease_factor)
+                    self.last_decrease = now
+            else:
+                # +1 per full window of successful calls
+                self.limit = min(self.maximum, self.limit + 1.0 / self.limit)
+            self.condition.notify_all()
+
+def backoff_delay(attempt, base, cap):
+    """Exponential backoff with full jitter for the given (0-based) retry attempt"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+def error_status(exc):
+    """HTTP status carried by a requests, urllib or google-api-core exception, if any"""
+    response = getattr(exc, 'response', None)
+    status = getattr(response, 'status_code', None)
+    if status is None:
+        status = getattr(exc, 'code', None)
+    return status if isinstance(status, int) else None
+
+def retry_after_seconds(exc):
+    """Retry-After hint (in seconds) sent with a throttling response, if any"""
+    response = getattr(exc, 'response', None)
+    headers = getattr(response, 'headers', None) or getattr(exc, 'headers', None) or {}
+    try:
+        return float(headers.get('Retry-After'))
+    except (TypeError, ValueError):
+        return None
+
+def is_retryable(exc):
+    """Retry throttling, server errors, timeouts and connection failures, but not client errors"""
+    status = error_status(exc)
+    if status is not None:
+        return status in RETRYABLE_STATUSES
+    # requests' ConnectionError/Timeout derive from OSError, as do socket timeouts
+    return isinstance(exc, (OSError, TimeoutError))
+
+class IOController:
+    """Runs I/O calls against one host under a rate limit and an adaptive concurrency limit,
+    retrying with jittered exponential backoff and optionally hedging slow idempotent calls"""
+
+    def __init__(self, host, config):
+        self.host = host
+        self.config = config
+        # The host's rate is split across the processes that call it at the same time
+        processes = max(config.get('processes', 1), 1)
+        self.bucket = TokenBucket(config['rate_per_second'] / processes, max(config['burst'] / processes, 1))
+        self.limiter = AdaptiveConcurrencyLimiter(
+            config['initial_concurrency'],
+            config['min_concurrency'],
+            config['max_concurrency'],
+            config['target_latency_seconds'],
+        )
+        self.hedge_pool = ThreadPoolExecutor(max_workers=config['max_concurrency'] * 2,
+                                             thread_name_prefix=f"hedge-{host}")
+        self.stats_lock = threading.Lock()
+        self.counters = {'calls': 0, 'attempts': 0, 'retries': 0, 'throttled': 0, 'hedges': 0, 'failures': 0}
+
+    def _count(self, name, amount=1):
+        with self.stats_lock:
+            self.counters[name] += amount
+
+    def _attempt(self, fn, args, kwargs, started_event=None):
+        """One rate-limited, concurrency-limited attempt; returns the result or raises"""
+        self.bucket.acquire()
+        self.limiter.acquire()
+        self._count('attempts')
+        if started_event is not None:
+            started_event.set()
+        started = time.monotonic()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as exc:
+            status = error_status(exc)
+            throttled = status in THROTTLE_STATUSES
+            if throttled:
+                self._count('throttled')
+            self.limiter.release(time.monotonic() - started, ok=False, throttled=throttled)
+            raise
+        self.limiter.release(time.monotonic() - started, ok=True)
+        return result
+
+    def _hedged_attempt(self, fn, args, kwargs, hedge_after):
+        """Start a duplicate attempt if the first is slower than `hedge_after`; first success wins"""
+        started_event = threading.Event()
+        futures = [self.hedge_pool.submit(self._attempt, fn, args, kwargs, started_event)]
+        # Time the hedge from when the call reaches the server, not from time spent queued locally
+        while not started_event.wait(timeout=0.05) and not futures[0].done():
+            pass
+        done, _ = wait(futures, timeout=hedge_after)
+        if not done:
+            self._count('hedges')
+            futures.append(self.hedge_pool.submit(self._attempt, fn, args, kwargs))
+
+        error = None
+        pending = set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def call(self, fn, *args, idempotent=True, **kwargs):
+        """Call `fn(*args, **kwargs)` with rate limiting, adaptive concurrency, retries and hedging
+
+        Only idempotent calls are hedged; pass idempotent=False for writes.
+        """
+        self._count('calls')
+        hedge_after = self.config.get('hedge_after_seconds')
+        max_attempts = self.config['max_attempts']
+
+        for attempt in range(max_attempts):
+            try:
+                if hedge_after and idempotent:
+                    return self._hedged_attempt(fn, args, kwargs, hedge_after)
+                return self._attempt(fn, args, kwargs)
+            except Exception as exc:
+                if not is_retryable(exc) or attempt == max_attempts - 1:
+                    self._count('failures')
+                    raise
+                delay = backoff_delay(attempt, self.config['backoff_base_seconds'], self.config['backoff_max_seconds'])
+                delay = max(delay, retry_after_seconds(exc) or 0)
+                self._count('retries')
+                print(f" {self.host}: attempt {attempt + 1} failed ({exc}), retrying in {delay:.2f}s")
+                time.sleep(delay)
+
+    def stats(self):
+        """Counters plus the current concurrency limit"""
+        with self.stats_lock:
+            return {**self.counters, 'concurrency_limit': round(self.limiter.limit, 2)}
+
+_CONTROLLERS = {}
+_CONTROLLERS_LOCK = threading.Lock()
+
+def get_io_controller(host):
+    """Controller shared by every thread of this process for a host, configured from IO_CONTROL_CONFIG
+    (host entries override 'default')
+
+    Other processes have their own controllers, which is what the 'processes' setting accounts for.
+    """
+    with _CONTROLLERS_LOCK:
+        if host not in _CONTROLLERS:
+            config = {**IO_CONTROL_CONFIG['default'], **IO_CONTROL_CONFIG.get(host, {})}
+            _CONTROLLERS[host] = IOController(host, config)
+        return _CONTROLLERS[host]
@@ -0,0 +1,26 @@
+# Lazy, on-demand loading of heavy third-party modules
+import importlib
+import sys
+import types
+
+class _DeferredModule(types.ModuleType):
+    """Stand-in for a module that is only imported on first attribute access"""
+
+    def __getattr__(self, attr):
+        module = self.__dict__.get('_deferred_module')
+        if module is None:
+            module = importlib.import_module(self.__name__)
+            self.__dict__['_deferred_module'] = module
+        return getattr(module, attr)
+
+def lazy_import(name):
+    """Import a module lazily: it is only executed on first attribute access
+
+    Keeps DAG parsing and task start-up fast, since pandas, pyarrow, the Google
+    Cloud clients and requests are only loaded by the code paths that use them.
+    Submodules such as ``pyarrow.parquet`` stay lazy too, because nothing (not
+    even the parent package) is imported until an attribute is used.
+    """
+    if name in sys.modules:
+        return sys.modules[name]
+    return _DeferredModule(name)
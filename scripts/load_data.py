@@ -1,20 +1,26 @@
-# Import the required libraries
-from google.cloud import bigquery
-from google.cloud.exceptions import NotFound
+# Import the required libraries (heavy ones are loaded lazily on first use)
+import io
 from datetime import datetime
 
-# Import configuration with error handling
-try:
-    from config.gcp_config import *
-except ImportError:
-    # Fallback for when running directly or in VSCode
-    import sys
-    import os
-    # Add project root to path
-    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    if project_root not in sys.path:
-        sys.path.append(project_root)
-    from config.gcp_config import *
+from config.gcp_config import (
+    BQ_CLEAN_CARTS_TABLE,
+    BQ_CLEAN_PRODUCTS_TABLE,
+    BQ_CLEAN_USERS_TABLE,
+    BQ_DATASET,
+    BQ_LOCATION,
+    BQ_METADATA_TABLE,
+    BQ_STAGING_CARTS_TABLE,
+    BQ_STAGING_PRODUCTS_TABLE,
+    BQ_STAGING_USERS_TABLE,
+    GCP_PROJECT_ID,
+)
+from scripts.lazy_imports import lazy_import
+from scripts.memory_budget import chunk_size, iter_chunks, print_memory_report, track_stage
+
+bigquery = lazy_import('google.cloud.bigquery')
+google_exceptions = lazy_import('google.api_core.exceptions')
+pa = lazy_import('pyarrow')
+pq = lazy_import('pyarrow.parquet')
 
 def create_metadata_table():
     """Create pipeline metadata table"""
@@ -33,27 +39,13 @@ def create_metadata_table():
     try:
         client.get_table(table_ref)
         print(f"Table {BQ_METADATA_TABLE} already exists")
-    except NotFound:
+    except google_exceptions.NotFound:
         table = bigquery.Table(table_ref, schema=schema)
         client.create_table(table)
         print(f"Created table {BQ_METADATA_TABLE}")
 
-def create_bq_tables_if_not_exist():
-    """Create BigQuery tables if they don't exist with incremental support"""
-    client = bigquery.Client(project=GCP_PROJECT_ID)
-    
-    dataset_ref = client.dataset(BQ_DATASET)
-    try:
-        client.get_dataset(dataset_ref)
-        print(f"Dataset {BQ_DATASET} already exists")
-    except NotFound:
-        dataset = bigquery.Dataset(dataset_ref)
-        dataset.location = "US"
-        client.create_dataset(dataset)
-        print(f"Created dataset {BQ_DATASET}")
-
-    create_metadata_table()
-
+def get_clean_table_schemas():
+    """Schemas of the clean (and staging) tables, keyed by data type"""
     users_schema = [
         bigquery.SchemaField("user_id", "INTEGER", mode="REQUIRED"),
         bigquery.SchemaField("first_name", "STRING", mode="REQUIRED"),
@@ -83,8 +75,38 @@ def create_bq_tables_if_not_exist():
         bigquery.SchemaField("price", "FLOAT", mode="REQUIRED"),
         bigquery.SchemaField("total_cart_value", "FLOAT", mode="REQUIRED"),
         bigquery.SchemaField("load_timestamp", "TIMESTAMP", mode="REQUIRED"),
+        # Product attributes denormalized at transform time (NULL when the product is unknown)
+        bigquery.SchemaField("category", "STRING", mode="NULLABLE"),
+        bigquery.SchemaField("brand", "STRING", mode="NULLABLE"),
     ]
     
+    return {
+        'users': users_schema,
+        'products': products_schema,
+        'carts': carts_schema,
+    }
+
+def create_bq_tables_if_not_exist():
+    """Create BigQuery tables if they don't exist with incremental support"""
+    client = bigquery.Client(project=GCP_PROJECT_ID)
+    
+    dataset_ref = client.dataset(BQ_DATASET)
+    try:
+        client.get_dataset(dataset_ref)
+        print(f"Dataset {BQ_DATASET} already exists")
+    except google_exceptions.NotFound:
+        dataset = bigquery.Dataset(dataset_ref)
+        dataset.location = BQ_LOCATION
+        client.create_dataset(dataset)
+        print(f"Created dataset {BQ_DATASET}")
+
+    create_metadata_table()
+
+    schemas = get_clean_table_schemas()
+    users_schema = schemas['users']
+    products_schema = schemas['products']
+    carts_schema = schemas['carts']
+    
     staging_users_schema = users_schema
     staging_products_schema = products_schema
     staging_carts_schema = carts_schema
@@ -101,47 +123,168 @@ def create_bq_tables_if_not_exist():
     for table_name, schema in tables_config.items():
         table_ref = dataset_ref.table(table_name)
         try:
-            client.get_table(table_ref)
+            table = client.get_table(table_ref)
             print(f"Table {table_name} already exists")
-        except NotFound:
+            added = add_missing_columns(client, table, schema)
+            if added and table_name == BQ_CLEAN_CARTS_TABLE:
+                backfill_cart_product_attributes(client)
+        except google_exceptions.NotFound:
             table = bigquery.Table(table_ref, schema=schema)
             client.create_table(table)
             print(f"Created table {table_name}")
 
+def add_missing_columns(client, table, schema):
+    """Add schema fields missing from an existing table (new columns must be NULLABLE); returns their names"""
+    existing = {field.name for field in table.schema}
+    missing = [field for field in schema if field.name not in existing]
+    if not missing:
+        return []
+    
+    table.schema = list(table.schema) + missing
+    client.update_table(table, ["schema"])
+    print(f"Added columns {', '.join(field.name for field in missing)} to {table.table_id}")
+    return [field.name for field in missing]
+
+def backfill_cart_product_attributes(client):
+    """One-off fill of the new carts product attributes from products_table for rows loaded before them
+
+    Waited on during setup on purpose, so no lane loads carts while the UPDATE runs.
+    """
+    query = f"""
+    UPDATE `{GCP_PROJECT_ID}.{BQ_DATASET}.{BQ_CLEAN_CARTS_TABLE}` c
+    SET category = p.category,
+        brand = p.brand
+    FROM `{GCP_PROJECT_ID}.{BQ_DATASET}.{BQ_CLEAN_PRODUCTS_TABLE}` p
+    WHERE c.product_id = p.product_id
+      AND c.category IS NULL
+    """
+    query_job = client.query(query, location=BQ_LOCATION)
+    query_job.result()
+    print(f"Filled product attributes on {query_job.num_dml_affected_rows} existing cart rows")
+
 def is_table_empty(table_name):
-    """Check if a table is empty (first run detection)"""
+    """Check if a table is empty (first run detection)
+
+    Reads the row count from the table metadata, so no query job is run or waited on.
+    """
     try:
         client = bigquery.Client(project=GCP_PROJECT_ID)
-        query = f"SELECT COUNT(*) as count FROM `{GCP_PROJECT_ID}.{BQ_DATASET}.{table_name}`"
-        query_job = client.query(query)
-        results = query_job.result()
-        
-        for row in results:
-            return row.count == 0
+        table = client.get_table(f"{GCP_PROJECT_ID}.{BQ_DATASET}.{table_name}")
+        return not table.num_rows
     except Exception as e:
         print(f"Could not check if {table_name} is empty: {e}")
         return True  
+
+def schema_for_table(table_name):
+    """BigQuery schema of a clean or staging table"""
+    schemas = get_clean_table_schemas()
+    for data_type, config in TABLE_MAPPING.items():
+        if table_name in (config['target'], config['staging']):
+            return schemas[data_type]
+    raise ValueError(f"Unknown table: {table_name}")
+
+def arrow_type_for_field(bq_field):
+    """Arrow type for a BigQuery field, used for columns that are all NULL in a batch"""
+    return {
+        'STRING': pa.string(),
+        'INTEGER': pa.int64(),
+        'FLOAT': pa.float64(),
+        'BOOLEAN': pa.bool_(),
+        'TIMESTAMP': pa.timestamp('us', tz='UTC'),
+    }.get(bq_field.field_type, pa.null())
+
+def arrow_table_for_schema(df, schema):
+    """Convert a DataFrame to an Arrow table whose types and nullability match a BigQuery schema
+
+    Categorical columns become Arrow dictionaries and stay dictionary-encoded in the
+    Parquet file, so repeated strings are uploaded once per row group.
+    """
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    modes = {field.name: field for field in schema}
     
-    return False
+    fields, columns = [], []
+    for field, column in zip(table.schema, table.columns):
+        bq_field = modes.get(field.name)
+        if bq_field is not None and bq_field.field_type == 'TIMESTAMP':
+            # Naive timestamps are UTC, as load_table_from_dataframe treats them
+            column = column.cast(pa.timestamp('us', tz='UTC'))
+            field = field.with_type(column.type)
+        elif bq_field is not None and pa.types.is_null(field.type):
+            # Otherwise later batches with values could not be appended to the same file
+            column = column.cast(arrow_type_for_field(bq_field))
+            field = field.with_type(column.type)
+        # REQUIRED columns must be non-nullable in the file to load into the table schema
+        fields.append(field.with_nullable(bq_field is None or bq_field.mode != 'REQUIRED'))
+        columns.append(column)
+    return pa.Table.from_arrays(columns, schema=pa.schema(fields))
+
+def dataframe_to_parquet(df, schema):
+    """Encode a DataFrame as Parquet matching a BigQuery schema"""
+    buffer = io.BytesIO()
+    pq.write_table(arrow_table_for_schema(df, schema), buffer, use_dictionary=True, compression='snappy')
+    buffer.seek(0)
+    return buffer
 
-def load_to_staging(df, staging_table_name):
-    """Load data to staging table"""
+def load_dataframe_in_batches(client, df, table_id, schema, wait=True, job_id_prefix=None):
+    """Truncate-load a DataFrame with one load job and return it (waiting for it only when wait=True)
+
+    The DataFrame is encoded in memory-budget-sized batches, each written as a row group
+    of a single Parquet file, so the table is replaced atomically by one job.
+    """
+    stage = f"load_{table_id.rsplit('.', 1)[-1]}"
+    size = chunk_size(stage)
+    parquet_file = io.BytesIO()
+    writer = None
+    row_groups = 0
+    
+    with track_stage(stage) as tracker:
+        try:
+            for batch in iter_chunks(df, size):
+                table = arrow_table_for_schema(batch, schema)
+                if writer is None:
+                    writer = pq.ParquetWriter(parquet_file, table.schema, use_dictionary=True, compression='snappy')
+                elif table.schema != writer.schema:
+                    # Batches may infer different dictionary index widths or nullability
+                    table = table.cast(writer.schema)
+                writer.write_table(table, row_group_size=len(batch))
+                row_groups += 1
+        finally:
+            if writer is not None:
+                writer.close()
+        tracker.records = len(df)
+    
+    upload_bytes = parquet_file.getbuffer().nbytes
+    parquet_file.seek(0)
+    job_config = bigquery.LoadJobConfig(
+        source_format=bigquery.SourceFormat.PARQUET,
+        schema=schema,
+        write_disposition="WRITE_TRUNCATE",
+    )
+    job = client.load_table_from_file(
+        parquet_file, table_id, job_config=job_config, job_id_prefix=job_id_prefix, location=BQ_LOCATION
+    )
+    if wait:
+        job.result()
+    
+    print(f"Uploaded {len(df)} rows to {table_id} as {upload_bytes / 1e6:.2f} MB of Parquet "
+          f"in {row_groups} row group(s)")
+    return job
+
+def load_to_staging(df, staging_table_name, wait=True, job_id_prefix=None):
+    """Load data to staging table (returns the job ID instead of waiting when wait=False)"""
     if df is None or df.empty:
         print(f"No data to load to staging table {staging_table_name}")
-        return 0
+        return 0 if wait else None
         
     try:
         client = bigquery.Client(project=GCP_PROJECT_ID)
         table_id = f"{GCP_PROJECT_ID}.{BQ_DATASET}.{staging_table_name}"
         
-        job_config = bigquery.LoadJobConfig(
-            write_disposition="WRITE_TRUNCATE",
-        )
-        
-        job = client.load_table_from_dataframe(
-            df, table_id, job_config=job_config
-        )
-        job.result()
+        job = load_dataframe_in_batches(
+            client, df, table_id, schema_for_table(staging_table_name), wait=wait, job_id_prefix=job_id_prefix)
+        if not wait:
+            print(f"Submitted staging load job {job.job_id} for {staging_table_name}")
+            return job.job_id
         
         table = client.get_table(table_id)
         print(f"Loaded {table.num_rows} rows to staging table {staging_table_name}")
@@ -151,24 +294,21 @@ def load_to_staging(df, staging_table_name):
         print(f"Error loading data to staging table {staging_table_name}: {e}")
         raise
 
-def load_direct_insert(df, target_table_name):
+def load_direct_insert(df, target_table_name, wait=True, job_id_prefix=None):
     """Direct INSERT for first run (faster than MERGE on empty tables)"""
     if df is None or df.empty:
         print(f"No data to load to {target_table_name}")
-        return 0
+        return 0 if wait else None
         
     try:
         client = bigquery.Client(project=GCP_PROJECT_ID)
         table_id = f"{GCP_PROJECT_ID}.{BQ_DATASET}.{target_table_name}"
         
-        job_config = bigquery.LoadJobConfig(
-            write_disposition="WRITE_TRUNCATE",  
-        )
-        
-        job = client.load_table_from_dataframe(
-            df, table_id, job_config=job_config
-        )
-        job.result()
+        job = load_dataframe_in_batches(
+            client, df, table_id, schema_for_table(target_table_name), wait=wait, job_id_prefix=job_id_prefix)
+        if not wait:
+            print(f"FIRST RUN: Submitted direct INSERT job {job.job_id} for {target_table_name}")
+            return job.job_id
         
         table = client.get_table(table_id)
         print(f"FIRST RUN: Loaded {table.num_rows} rows to {target_table_name} via direct INSERT")
@@ -178,15 +318,19 @@ def load_direct_insert(df, target_table_name):
         print(f"Error loading data to {target_table_name}: {e}")
         raise
 
-def merge_from_staging(target_table, staging_table, merge_key):
-    """Merge data from staging to target table for incremental runs"""
+def merge_from_staging(target_table, staging_table, merge_key, wait=True):
+    """Merge data from staging to target table for incremental runs
+
+    `merge_key` is a column or a list of columns that identify one row of the table.
+    """
     try:
         client = bigquery.Client(project=GCP_PROJECT_ID)
+        keys = [merge_key] if isinstance(merge_key, str) else list(merge_key)
         
         query = f"""
         MERGE `{GCP_PROJECT_ID}.{BQ_DATASET}.{target_table}` T
         USING `{GCP_PROJECT_ID}.{BQ_DATASET}.{staging_table}` S
-        ON T.{merge_key} = S.{merge_key}
+        ON {' AND '.join(f'T.{key} = S.{key}' for key in keys)}
         WHEN MATCHED THEN
             UPDATE SET 
                 {get_update_columns(target_table)}
@@ -195,7 +339,10 @@ def merge_from_staging(target_table, staging_table, merge_key):
             VALUES ({get_insert_columns(staging_table)})
         """
         
-        query_job = client.query(query)
+        query_job = client.query(query, location=BQ_LOCATION)
+        if not wait:
+            print(f"INCREMENTAL: Submitted MERGE job {query_job.job_id} for {target_table}")
+            return query_job.job_id
         query_job.result()
         
         # Get merge statistics
@@ -235,7 +382,9 @@ def get_update_columns(table_name):
             quantity = S.quantity,
             price = S.price,
             total_cart_value = S.total_cart_value,
-            load_timestamp = S.load_timestamp
+            load_timestamp = S.load_timestamp,
+            category = S.category,
+            brand = S.brand
         """
     else:
         raise ValueError(f"Unknown table: {table_name}")
@@ -247,65 +396,99 @@ def get_insert_columns(table_name):
     elif 'products' in table_name:
         return "product_id, name, category, brand, price, load_timestamp"
     elif 'carts' in table_name:
-        return "cart_id, user_id, product_id, quantity, price, total_cart_value, load_timestamp"
+        return "cart_id, user_id, product_id, quantity, price, total_cart_value, load_timestamp, category, brand"
     else:
         raise ValueError(f"Unknown table: {table_name}")
 
+TABLE_MAPPING = {
+    'users': {
+        'staging': BQ_STAGING_USERS_TABLE,
+        'target': BQ_CLEAN_USERS_TABLE,
+        'merge_key': 'user_id',
+        'row_keys': ['user_id']
+    },
+    'products': {
+        'staging': BQ_STAGING_PRODUCTS_TABLE, 
+        'target': BQ_CLEAN_PRODUCTS_TABLE,
+        'merge_key': 'product_id',
+        'row_keys': ['product_id']
+    },
+    'carts': {
+        'staging': BQ_STAGING_CARTS_TABLE,
+        'target': BQ_CLEAN_CARTS_TABLE,
+        'merge_key': 'cart_id',
+        # Carts hold one row per cart product, so a MERGE must match on both
+        'row_keys': ['cart_id', 'product_id']
+    }
+}
+
+def load_entity_data(data_type, df):
+    """Load a single transformed dataset with smart first-run detection"""
+    if df is None or df.empty:
+        print(f"No data to load for {data_type}")
+        return 0
+    
+    config = TABLE_MAPPING[data_type]
+    target_table = config['target']
+    
+    # Check if this is first run (table is empty)
+    is_first_run = is_table_empty(target_table)
+    
+    if is_first_run:
+        print(f"FIRST RUN DETECTED for {data_type}")
+        print(f"   Using DIRECT INSERT (faster for empty tables)")
+        
+        # First run - use direct insert (faster)
+        records_loaded = load_direct_insert(df, target_table)
+        
+    else:
+        print(f"INCREMENTAL RUN DETECTED for {data_type}")
+        print(f"   Using MERGE pattern for incremental load")
+        
+        # Incremental run - use staging + merge
+        records_loaded = load_to_staging(df, config['staging'])
+        merge_from_staging(config['target'], config['staging'], config['row_keys'])
+    
+    print(f"Successfully loaded {records_loaded} records for {data_type}")
+    return records_loaded
+
+# Prefix of staging load job IDs, so the MERGE step can tell a staged load from a direct insert
+STAGING_JOB_PREFIX = "staging_"
+
+def submit_entity_load(data_type, df):
+    """Submit the load job for one entity without waiting; returns the submitted job IDs"""
+    if df is None or df.empty:
+        print(f"No data to load for {data_type}")
+        return []
+    
+    config = TABLE_MAPPING[data_type]
+    
+    if is_table_empty(config['target']):
+        print(f"FIRST RUN DETECTED for {data_type}")
+        job_id = load_direct_insert(df, config['target'], wait=False, job_id_prefix=f"direct_{data_type}_")
+    else:
+        print(f"INCREMENTAL RUN DETECTED for {data_type}")
+        job_id = load_to_staging(df, config['staging'], wait=False, job_id_prefix=f"{STAGING_JOB_PREFIX}{data_type}_")
+    
+    return [job_id]
+
+def submit_entity_merge(data_type, load_job_ids):
+    """Submit the staging MERGE for one entity if its data went through staging"""
+    if not any(job_id.startswith(STAGING_JOB_PREFIX) for job_id in load_job_ids or []):
+        return []
+    
+    config = TABLE_MAPPING[data_type]
+    return [merge_from_staging(config['target'], config['staging'], config['row_keys'], wait=False)]
+
 def load_incremental_data(transformed_data):
     """Load transformed data with smart first-run detection"""
     create_bq_tables_if_not_exist()
     
     load_results = {}
     
-    table_mapping = {
-        'users': {
-            'staging': BQ_STAGING_USERS_TABLE,
-            'target': BQ_CLEAN_USERS_TABLE,
-            'merge_key': 'user_id'
-        },
-        'products': {
-            'staging': BQ_STAGING_PRODUCTS_TABLE, 
-            'target': BQ_CLEAN_PRODUCTS_TABLE,
-            'merge_key': 'product_id'
-        },
-        'carts': {
-            'staging': BQ_STAGING_CARTS_TABLE,
-            'target': BQ_CLEAN_CARTS_TABLE,
-            'merge_key': 'cart_id'
-        }
-    }
-    
     for data_type, df in transformed_data.items():
-        if df is None or df.empty:
-            print(f"No data to load for {data_type}")
-            load_results[data_type] = 0
-            continue
-            
         try:
-            config = table_mapping[data_type]
-            target_table = config['target']
-            
-            # Check if this is first run (table is empty)
-            is_first_run = is_table_empty(target_table)
-            
-            if is_first_run:
-                print(f"FIRST RUN DETECTED for {data_type}")
-                print(f"   Using DIRECT INSERT (faster for empty tables)")
-                
-                # First run - use direct insert (faster)
-                records_loaded = load_direct_insert(df, target_table)
-                
-            else:
-                print(f"INCREMENTAL RUN DETECTED for {data_type}")
-                print(f"   Using MERGE pattern for incremental load")
-                
-                # Incremental run - use staging + merge
-                records_loaded = load_to_staging(df, config['staging'])
-                merge_from_staging(config['target'], config['staging'], config['merge_key'])
-            
-            load_results[data_type] = records_loaded
-            
-            print(f"Successfully loaded {records_loaded} records for {data_type}")
+            load_results[data_type] = load_entity_data(data_type, df)
             
         except Exception as e:
             print(f"Failed to load {data_type} data: {e}")
@@ -319,6 +502,7 @@ def load_incremental_data(transformed_data):
     print(f"Total records loaded: {total_records}")
     for data_type, count in load_results.items():
         print(f"  {data_type}: {count} records")
+    print_memory_report()
     print("="*50)
     
     return load_results
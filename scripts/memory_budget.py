@@ -0,0 +1,119 @@
+# Memory-budget-aware execution: per-stage peak RSS tracking and automatic chunk sizing
+import os
+import threading
+
+from config.gcp_config import MEMORY_BUDGET_CONFIG
+
+MB = 1024 * 1024
+
+# Observed memory per stage: peak RSS, growth during the stage, records and bytes per record.
+# Kept per process only, so every Airflow task starts from default_bytes_per_record.
+_STAGE_REPORT = {}
+_REPORT_LOCK = threading.Lock()
+
+def current_rss_bytes():
+    """Resident set size of this process (Linux /proc, falling back to the peak from getrusage)"""
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        import sys
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # ru_maxrss is in bytes on macOS and kilobytes on Linux
+        return peak if sys.platform == 'darwin' else peak * 1024
+
+def budget_bytes():
+    """The configured memory budget for this process"""
+    return MEMORY_BUDGET_CONFIG['budget_mb'] * MB
+
+class StageMemoryTracker:
+    """Context manager that samples RSS in the background and records the stage's peak
+
+    Set ``tracker.records`` inside the block so the stage's bytes per record can be
+    learned and used to size the next chunks of the same stage.
+    """
+
+    def __init__(self, stage):
+        self.stage = stage
+        self.records = 0
+        self.baseline = 0
+        self.peak = 0
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def _sample(self):
+        interval = MEMORY_BUDGET_CONFIG['sample_interval_seconds']
+        while not self._stop.wait(interval):
+            self.peak = max(self.peak, current_rss_bytes())
+
+    def __enter__(self):
+        self.baseline = self.peak = current_rss_bytes()
+        self._sampler = threading.Thread(target=self._sample, name=f"memory-{self.stage}", daemon=True)
+        self._sampler.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._stop.set()
+        self._sampler.join()
+        self.peak = max(self.peak, current_rss_bytes())
+
+        growth = max(self.peak - self.baseline, 0)
+        with _REPORT_LOCK:
+            previous = _STAGE_REPORT.get(self.stage, {})
+            entry = {
+                'peak_rss_mb': round(max(self.peak / MB, previous.get('peak_rss_mb', 0)), 1),
+                'growth_mb': round(growth / MB, 1),
+                'records': self.records,
+                'bytes_per_record': previous.get('bytes_per_record'),
+            }
+            if self.records and growth:
+                # RSS rarely grows once a long-lived process has reused its freed memory, so
+                # keep the largest measurement rather than letting chunks grow to the maximum
+                entry['bytes_per_record'] = max(growth / self.records, entry['bytes_per_record'] or 0)
+            _STAGE_REPORT[self.stage] = entry
+
+        print(f" Memory [{self.stage}]: peak RSS {self.peak / MB:.1f} MB "
+              f"(+{growth / MB:.1f} MB for {self.records} records, budget {MEMORY_BUDGET_CONFIG['budget_mb']} MB)")
+        if self.peak > budget_bytes():
+            print(f" WARNING: {self.stage} peaked at {self.peak / MB:.1f} MB, "
+                  f"over the {MEMORY_BUDGET_CONFIG['budget_mb']} MB budget")
+        return False
+
+def track_stage(stage):
+    """Track peak memory of a pipeline stage: `with track_stage('transform_users') as tracker:`"""
+    return StageMemoryTracker(stage)
+
+def bytes_per_record(stage):
+    """Measured bytes per record for a stage, or the configured default before any measurement"""
+    with _REPORT_LOCK:
+        measured = _STAGE_REPORT.get(stage, {}).get('bytes_per_record')
+    return measured or MEMORY_BUDGET_CONFIG['default_bytes_per_record']
+
+def chunk_size(stage):
+    """Records per chunk so the stage fits in the remaining budget, given its bytes per record"""
+    available = max(budget_bytes() - current_rss_bytes(), 0) * MEMORY_BUDGET_CONFIG['chunk_headroom']
+    size = int(available / bytes_per_record(stage))
+    return max(MEMORY_BUDGET_CONFIG['min_chunk_records'], min(size, MEMORY_BUDGET_CONFIG['max_chunk_records']))
+
+def iter_chunks(items, size):
+    """Yield consecutive slices of a list (or DataFrame rows via iloc) of at most `size` items"""
+    slicer = items.iloc if hasattr(items, 'iloc') else items
+    for start in range(0, len(items), size):
+        yield slicer[start:start + size]
+
+def memory_report():
+    """Observed memory per stage so far in this process"""
+    with _REPORT_LOCK:
+        return {stage: dict(entry) for stage, entry in _STAGE_REPORT.items()}
+
+def print_memory_report():
+    """Print the observed peaks for the run summary"""
+    report = memory_report()
+    if not report:
+        return
+    print(f"Memory budget: {MEMORY_BUDGET_CONFIG['budget_mb']} MB")
+    for stage, entry in report.items():
+        per_record = entry['bytes_per_record']
+        per_record = f", {per_record:.0f} B/record" if per_record else ""
+        print(f"  {stage}: peak RSS {entry['peak_rss_mb']} MB, +{entry['growth_mb']} MB{per_record}")
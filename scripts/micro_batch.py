@@ -0,0 +1,324 @@
+# Continuous micro-batch mode: poll the sources every few seconds and stream small deltas
+import argparse
+import json
+import time
+from datetime import datetime
+
+from config.gcp_config import (
+    API_URLS,
+    BQ_CLEAN_CARTS_TABLE,
+    BQ_CLEAN_PRODUCTS_TABLE,
+    BQ_CLEAN_USERS_TABLE,
+    BQ_DATASET,
+    BQ_LOCATION,
+    BQ_STREAM_CARTS_TABLE,
+    BQ_STREAM_PRODUCTS_TABLE,
+    BQ_STREAM_USERS_TABLE,
+    GCP_PROJECT_ID,
+    MICRO_BATCH_CONFIG,
+)
+from scripts.extract_data import fetch_data_with_fallback
+from scripts.lazy_imports import lazy_import
+from scripts.load_data import (
+    TABLE_MAPPING,
+    add_missing_columns,
+    get_clean_table_schemas,
+    get_insert_columns,
+    get_update_columns,
+)
+from scripts.memory_budget import iter_chunks
+from scripts.transform_data import (
+    DIMENSION_INDEX_BUILDERS,
+    get_max_ids_from_target,
+    load_dimension_index,
+    transform_carts_data,
+    transform_products_data,
+    transform_users_data,
+    update_sketches,
+)
+from scripts.validate_data import validate_and_quarantine
+
+pd = lazy_import('pandas')
+bigquery = lazy_import('google.cloud.bigquery')
+google_exceptions = lazy_import('google.api_core.exceptions')
+
+TRANSFORMS = {
+    'users': transform_users_data,
+    'products': transform_products_data,
+    'carts': transform_carts_data,
+}
+
+STREAM_TABLES = {
+    'users': (BQ_STREAM_USERS_TABLE, BQ_CLEAN_USERS_TABLE),
+    'products': (BQ_STREAM_PRODUCTS_TABLE, BQ_CLEAN_PRODUCTS_TABLE),
+    'carts': (BQ_STREAM_CARTS_TABLE, BQ_CLEAN_CARTS_TABLE),
+}
+
+# Keys identifying one row of each clean table (carts hold one row per cart product)
+ROW_KEYS = {data_type: config['row_keys'] for data_type, config in TABLE_MAPPING.items()}
+
+def dataframe_to_rows(df):
+    """JSON-ready rows (ISO timestamps, plain Python numbers) for streaming inserts"""
+    return json.loads(df.to_json(orient='records', date_format='iso'))
+
+class InMemorySink:
+    """Fake sink that keeps streamed and compacted rows in memory, for local runs and tests"""
+
+    def __init__(self):
+        self.stream = {data_type: [] for data_type in STREAM_TABLES}
+        self.clean = {data_type: {} for data_type in STREAM_TABLES}
+        self.commits = 0
+        self.compactions = 0
+
+    def append(self, data_type, df):
+        self.stream[data_type].extend(dataframe_to_rows(df))
+        self.commits += 1
+
+    def compact(self, data_type):
+        for row in self.stream[data_type]:
+            key = tuple(row[column] for column in ROW_KEYS[data_type])
+            current = self.clean[data_type].get(key)
+            if current is None or row['load_timestamp'] > current['load_timestamp']:
+                self.clean[data_type][key] = row
+        self.stream[data_type] = []
+        self.compactions += 1
+
+class BigQueryStreamingSink:
+    """Streams rows into `{entity}_stream` tables and MERGEs them into the clean tables"""
+
+    def __init__(self):
+        self.client = bigquery.Client(project=GCP_PROJECT_ID)
+
+    def ensure_stream_tables(self):
+        """Create the stream tables (partitioned by load time, short retention) if missing"""
+        schemas = get_clean_table_schemas()
+        for data_type, (stream_table, _) in STREAM_TABLES.items():
+            table_ref = self.client.dataset(BQ_DATASET).table(stream_table)
+            try:
+                add_missing_columns(self.client, self.client.get_table(table_ref), schemas[data_type])
+            except google_exceptions.NotFound:
+                table = bigquery.Table(table_ref, schema=schemas[data_type])
+                table.time_partitioning = bigquery.TimePartitioning(
+                    type_=bigquery.TimePartitioningType.DAY,
+                    field='load_timestamp',
+                    expiration_ms=MICRO_BATCH_CONFIG['stream_retention_days'] * 24 * 3600 * 1000,
+                )
+                self.client.create_table(table)
+                print(f"Created stream table {stream_table}")
+
+    def append(self, data_type, df):
+        """Low-latency streaming insert; rows are queryable within seconds"""
+        stream_table, _ = STREAM_TABLES[data_type]
+        table_id = f"{GCP_PROJECT_ID}.{BQ_DATASET}.{stream_table}"
+
+        for chunk in iter_chunks(df, MICRO_BATCH_CONFIG['batch_size']):
+            rows = dataframe_to_rows(chunk)
+            # Row IDs let BigQuery drop duplicates when a retried insert is resent
+            row_ids = [
+                "-".join(str(row[column]) for column in ROW_KEYS[data_type] + ['load_timestamp'])
+                for row in rows
+            ]
+            errors = self.client.insert_rows_json(table_id, rows, row_ids=row_ids)
+            if errors:
+                raise RuntimeError(f"Streaming insert into {stream_table} failed: {errors[:3]}")
+
+    def compact(self, data_type):
+        """MERGE the latest streamed version of each row into the clean table"""
+        stream_table, clean_table = STREAM_TABLES[data_type]
+        keys = ROW_KEYS[data_type]
+
+        query = f"""
+        MERGE `{GCP_PROJECT_ID}.{BQ_DATASET}.{clean_table}` T
+        USING (
+            SELECT * FROM `{GCP_PROJECT_ID}.{BQ_DATASET}.{stream_table}`
+            WHERE TRUE
+            QUALIFY ROW_NUMBER() OVER (PARTITION BY {', '.join(keys)} ORDER BY load_timestamp DESC) = 1
+        ) S
+        ON {' AND '.join(f'T.{key} = S.{key}' for key in keys)}
+        WHEN MATCHED AND S.load_timestamp > T.load_timestamp THEN
+            UPDATE SET
+                {get_update_columns(clean_table)}
+        WHEN NOT MATCHED THEN
+            INSERT ({get_insert_columns(clean_table)})
+            VALUES ({get_insert_columns(clean_table)})
+        """
+        query_job = self.client.query(query, location=BQ_LOCATION)
+        query_job.result()
+        print(f"Compacted {stream_table} into {clean_table}. Rows affected: {query_job.num_dml_affected_rows}")
+
+class MicroBatchRunner:
+    """Polls the sources every `poll_interval` seconds and streams new records to a sink
+
+    Records are transformed with the batch transforms against per-entity ID watermarks,
+    buffered until `batch_size` rows or `commit_interval` seconds, then appended to the
+    sink; every `compaction_interval` seconds the sink compacts them into the clean tables.
+    New carts are also folded into the stored sketches unless `sketches` is False.
+    """
+
+    def __init__(self, sink, data_types=None, watermarks=None, fetch=fetch_data_with_fallback,
+                 poll_interval=None, batch_size=None, commit_interval=None, compaction_interval=None,
+                 sketches=True):
+        self.sink = sink
+        self.sketches = sketches
+        self.data_types = data_types or list(API_URLS)
+        self.watermarks = {data_type: 0 for data_type in self.data_types}
+        self.watermarks.update(watermarks or {})
+        self.fetch = fetch
+        self.poll_interval = poll_interval or MICRO_BATCH_CONFIG['poll_interval_seconds']
+        self.batch_size = batch_size or MICRO_BATCH_CONFIG['batch_size']
+        self.commit_interval = commit_interval or MICRO_BATCH_CONFIG['commit_interval_seconds']
+        self.compaction_interval = compaction_interval or MICRO_BATCH_CONFIG['compaction_interval_seconds']
+
+        self.dimension_indexes = {}
+        self.buffers = {data_type: [] for data_type in self.data_types}
+        self.last_poll = {data_type: datetime.now() for data_type in self.data_types}
+        self.last_commit = time.monotonic()
+        self.last_compaction = time.monotonic()
+        self.stats = {'polls': 0, 'rows_streamed': 0, 'commits': 0, 'compactions': 0, 'sink_errors': 0}
+
+    def buffered_rows(self):
+        return sum(len(df) for frames in self.buffers.values() for df in frames)
+
+    def refresh_dimension_indexes(self):
+        """Load the dimension indexes no poll has provided yet from the latest snapshots"""
+        for dimension in DIMENSION_INDEX_BUILDERS:
+            if dimension in self.dimension_indexes:
+                continue
+            try:
+                self.dimension_indexes[dimension] = load_dimension_index(dimension)
+            except Exception as e:
+                print(f"Could not load the {dimension} index, lookups against it will return nulls: {e}")
+                self.dimension_indexes[dimension] = None
+
+    def transform(self, data_type, raw_data):
+        """Run the batch transform above the entity's watermark, enriching carts from the product index"""
+        if data_type in DIMENSION_INDEX_BUILDERS:
+            # Each poll returns the full catalog, so it doubles as the dimension index
+            self.dimension_indexes[data_type] = DIMENSION_INDEX_BUILDERS[data_type](raw_data)
+        if data_type == 'carts':
+            self.refresh_dimension_indexes()
+            return transform_carts_data(raw_data, self.watermarks[data_type], self.dimension_indexes['products'])
+        return TRANSFORMS[data_type](raw_data, self.watermarks[data_type])
+
+    def poll_once(self):
+        """Fetch each source and buffer the records above its watermark"""
+        for data_type in self.data_types:
+            try:
+                raw_data = self.fetch(API_URLS[data_type], data_type, self.last_poll[data_type])
+                self.last_poll[data_type] = datetime.now()
+
+                records = raw_data.get(data_type, [])
+                df = validate_and_quarantine(self.transform(data_type, raw_data), data_type)
+                if records:
+                    self.watermarks[data_type] = max(self.watermarks[data_type], max(r['id'] for r in records))
+                if df is not None and not df.empty:
+                    self.buffers[data_type].append(df)
+                    if data_type == 'carts' and self.sketches:
+                        update_sketches(df, self.dimension_indexes['users'])
+            except Exception as e:
+                print(f"Micro-batch poll failed for {data_type}: {e}")
+        self.stats['polls'] += 1
+
+    def commit(self):
+        """Append every buffered delta to the sink
+
+        A failed append keeps that entity's buffer, and the commit is retried on the next cycle.
+        """
+        failed = False
+        for data_type, frames in self.buffers.items():
+            if not frames:
+                continue
+            df = pd.concat(frames, ignore_index=True)
+            try:
+                self.sink.append(data_type, df)
+            except Exception as e:
+                failed = True
+                self.stats['sink_errors'] += 1
+                print(f"Micro-batch commit failed for {data_type}, keeping {len(df)} buffered rows: {e}")
+                continue
+            self.buffers[data_type] = []
+            self.stats['rows_streamed'] += len(df)
+            print(f"Streamed {len(df)} {data_type} rows")
+        if not failed:
+            self.stats['commits'] += 1
+            self.last_commit = time.monotonic()
+        return not failed
+
+    def compact(self):
+        """Commit what is buffered, then compact the streamed rows into the clean tables
+
+        A failed compaction is logged and retried on the next cycle.
+        """
+        failed = not self.commit()
+        for data_type in self.data_types:
+            try:
+                self.sink.compact(data_type)
+            except Exception as e:
+                failed = True
+                self.stats['sink_errors'] += 1
+                print(f"Micro-batch compaction failed for {data_type}: {e}")
+        if not failed:
+            self.stats['compactions'] += 1
+            self.last_compaction = time.monotonic()
+        return not failed
+
+    def run_cycle(self):
+        """One poll, plus a commit and/or compaction when their thresholds are reached"""
+        self.poll_once()
+        now = time.monotonic()
+        if self.buffered_rows() >= self.batch_size or now - self.last_commit >= self.commit_interval:
+            self.commit()
+        if now - self.last_compaction >= self.compaction_interval:
+            self.compact()
+
+    def run(self, max_cycles=None):
+        """Poll until interrupted (or for `max_cycles` cycles), then flush and compact"""
+        print(f" STARTING MICRO-BATCH MODE: poll every {self.poll_interval}s, "
+              f"commit at {self.batch_size} rows or {self.commit_interval}s, "
+              f"compact every {self.compaction_interval}s")
+        cycles = 0
+        try:
+            while max_cycles is None or cycles < max_cycles:
+                started = time.monotonic()
+                self.run_cycle()
+                cycles += 1
+                if max_cycles is None or cycles < max_cycles:
+                    time.sleep(max(0.0, self.poll_interval - (time.monotonic() - started)))
+        except KeyboardInterrupt:
+            print("Stopping micro-batch mode...")
+        finally:
+            if not self.compact():
+                print(f"WARNING: stopping with {self.buffered_rows()} rows that did not reach the sink")
+            print(f"Micro-batch summary: {self.stats}")
+        return self.stats
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the pipeline continuously in micro-batches")
+    parser.add_argument('--entities', nargs='+', choices=list(API_URLS), help="Entities to poll")
+    parser.add_argument('--poll-interval', type=float, default=MICRO_BATCH_CONFIG['poll_interval_seconds'])
+    parser.add_argument('--batch-size', type=int, default=MICRO_BATCH_CONFIG['batch_size'])
+    parser.add_argument('--commit-interval', type=float, default=MICRO_BATCH_CONFIG['commit_interval_seconds'])
+    parser.add_argument('--compaction-interval', type=float, default=MICRO_BATCH_CONFIG['compaction_interval_seconds'])
+    parser.add_argument('--max-cycles', type=int, help="Stop after this many polls")
+    parser.add_argument('--fake-sink', action='store_true', help="Write to an in-memory sink instead of BigQuery")
+    args = parser.parse_args()
+
+    if args.fake_sink:
+        sink = InMemorySink()
+        watermarks = {}
+    else:
+        sink = BigQueryStreamingSink()
+        sink.ensure_stream_tables()
+        watermarks = get_max_ids_from_target()
+
+    runner = MicroBatchRunner(
+        sink,
+        data_types=args.entities,
+        watermarks=watermarks,
+        poll_interval=args.poll_interval,
+        batch_size=args.batch_size,
+        commit_interval=args.commit_interval,
+        compaction_interval=args.compaction_interval,
+        sketches=not args.fake_sink,
+    )
+    runner.run(max_cycles=args.max_cycles)
@@ -1,26 +1,31 @@
-# Import bigquery package
-from google.cloud import bigquery
+# Import bigquery package (loaded lazily on first use)
+from config.gcp_config import (
+    BQ_CART_DETAILS_TABLE,
+    BQ_CATEGORY_BUYERS_TABLE,
+    BQ_CATEGORY_SUMMARY_TABLE,
+    BQ_CLEAN_CARTS_TABLE,
+    BQ_CLEAN_USERS_TABLE,
+    BQ_DATASET,
+    BQ_LOCATION,
+    BQ_CITY_SPEND_TABLE,
+    BQ_USER_SUMMARY_TABLE,
+    GCP_PROJECT_ID,
+    SKETCH_CONFIG,
+)
+from scripts.lazy_imports import lazy_import
+from scripts.sketches import read_sketch_state
 
-# Import configuration with error handling
-try:
-    from config.gcp_config import *
-except ImportError:
-    # Fallback for when running directly or in VSCode
-    import sys
-    import os
-    # Add project root to path
-    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    if project_root not in sys.path:
-        sys.path.append(project_root)
-    from config.gcp_config import *
+bigquery = lazy_import('google.cloud.bigquery')
 
-def execute_bq_query(query):
-    """Execute BigQuery query and return results"""
+def execute_bq_query(query, wait=True):
+    """Execute BigQuery query and return results (or just the job ID when wait=False)"""
     client = bigquery.Client(project=GCP_PROJECT_ID)
-    query_job = client.query(query)
+    query_job = client.query(query, location=BQ_LOCATION)
+    if not wait:
+        return query_job.job_id
     return query_job.result()
 
-def create_incremental_user_summary():
+def create_incremental_user_summary(wait=True):
     """Create incremental user summary using latest data"""
     query = f"""
     CREATE OR REPLACE TABLE `{GCP_PROJECT_ID}.{BQ_DATASET}.{BQ_USER_SUMMARY_TABLE}` AS
@@ -44,28 +49,36 @@ def create_incremental_user_summary():
     LEFT JOIN latest_carts lc ON u.user_id = lc.user_id
     ORDER BY total_spent DESC
     """
+    if not wait:
+        job_id = execute_bq_query(query, wait=False)
+        print(f"Submitted user_summary rebuild job {job_id}")
+        return job_id
     execute_bq_query(query)
     print("Created/Updated user_summary table")
 
-def create_incremental_category_summary():
-    """Create incremental category summary"""
+def create_incremental_category_summary(wait=True):
+    """Create incremental category summary from the product attributes denormalized onto carts"""
     query = f"""
     CREATE OR REPLACE TABLE `{GCP_PROJECT_ID}.{BQ_DATASET}.{BQ_CATEGORY_SUMMARY_TABLE}` AS
     SELECT 
-        p.category,
+        c.category,
         SUM(c.total_cart_value) as total_sales,
         SUM(c.quantity) as total_items_sold,
         CURRENT_TIMESTAMP() as last_updated
-    FROM `{GCP_PROJECT_ID}.{BQ_DATASET}.{BQ_CLEAN_PRODUCTS_TABLE}` p
-    JOIN `{GCP_PROJECT_ID}.{BQ_DATASET}.{BQ_CLEAN_CARTS_TABLE}` c 
-        ON p.product_id = c.product_id
-    GROUP BY p.category
+    FROM `{GCP_PROJECT_ID}.{BQ_DATASET}.{BQ_CLEAN_CARTS_TABLE}` c
+    -- NULL category: product not in products_table, which the old join dropped too
+    WHERE c.category IS NOT NULL
+    GROUP BY c.category
     ORDER BY total_sales DESC
     """
+    if not wait:
+        job_id = execute_bq_query(query, wait=False)
+        print(f"Submitted category_summary rebuild job {job_id}")
+        return job_id
     execute_bq_query(query)
     print("Created/Updated category_summary table")
 
-def create_incremental_cart_details():
+def create_incremental_cart_details(wait=True):
     """Create incremental cart details"""
     query = f"""
     CREATE OR REPLACE TABLE `{GCP_PROJECT_ID}.{BQ_DATASET}.{BQ_CART_DETAILS_TABLE}` AS
@@ -79,13 +92,87 @@ def create_incremental_cart_details():
     FROM `{GCP_PROJECT_ID}.{BQ_DATASET}.{BQ_CLEAN_CARTS_TABLE}` c
     ORDER BY c.cart_id, c.product_id
     """
+    if not wait:
+        job_id = execute_bq_query(query, wait=False)
+        print(f"Submitted cart_details rebuild job {job_id}")
+        return job_id
     execute_bq_query(query)
     print("Created/Updated cart_details table")
 
+def quantile_columns():
+    """Column names of the configured quantiles, e.g. 0.9 -> p90"""
+    return {f"p{round(q * 100, 1):g}".replace('.', '_'): q for q in SKETCH_CONFIG['quantiles']}
+
+def load_report_rows(client, table_name, rows, schema, wait=True):
+    """Replace a report table with precomputed rows"""
+    job_config = bigquery.LoadJobConfig(schema=schema, write_disposition="WRITE_TRUNCATE")
+    job = client.load_table_from_json(
+        rows, f"{GCP_PROJECT_ID}.{BQ_DATASET}.{table_name}", job_config=job_config, location=BQ_LOCATION
+    )
+    if not wait:
+        print(f"Submitted {table_name} rebuild job {job.job_id}")
+        return job.job_id
+    job.result()
+    print(f"Created/Updated {table_name} table")
+
+def create_sketch_summaries(wait=True):
+    """Rebuild the distinct-buyer and spend-quantile reports from the stored sketches
+
+    The sketches already hold every transformed cart, so this never scans carts_table.
+    """
+    state, _ = read_sketch_state()
+    client = bigquery.Client(project=GCP_PROJECT_ID)
+    quantiles = quantile_columns()
+    last_updated = state['updated_at']
+    
+    buyers_rows = []
+    for category, buyers in state['distinct_buyers_by_category'].items():
+        quantity = state['quantity_by_category'].get(category)
+        row = {'category': category, 'distinct_buyers': buyers.count(), 'last_updated': last_updated}
+        for column, q in quantiles.items():
+            row[f"quantity_{column}"] = quantity.quantile(q) if quantity else None
+        buyers_rows.append(row)
+    
+    spend_rows = []
+    for city, spend in state['cart_value_by_city'].items():
+        row = {'city': city, 'carts': int(spend.count()), 'last_updated': last_updated}
+        for column, q in quantiles.items():
+            row[f"cart_value_{column}"] = spend.quantile(q)
+        spend_rows.append(row)
+    
+    buyers_schema = [
+        bigquery.SchemaField("category", "STRING", mode="REQUIRED"),
+        bigquery.SchemaField("distinct_buyers", "INTEGER", mode="REQUIRED"),
+        *[bigquery.SchemaField(f"quantity_{column}", "FLOAT") for column in quantiles],
+        bigquery.SchemaField("last_updated", "TIMESTAMP"),
+    ]
+    spend_schema = [
+        bigquery.SchemaField("city", "STRING", mode="REQUIRED"),
+        bigquery.SchemaField("carts", "INTEGER", mode="REQUIRED"),
+        *[bigquery.SchemaField(f"cart_value_{column}", "FLOAT") for column in quantiles],
+        bigquery.SchemaField("last_updated", "TIMESTAMP"),
+    ]
+    
+    return [
+        load_report_rows(client, BQ_CATEGORY_BUYERS_TABLE, buyers_rows, buyers_schema, wait),
+        load_report_rows(client, BQ_CITY_SPEND_TABLE, spend_rows, spend_schema, wait),
+    ]
+
 def run_all_analyses():
     """Run all analysis queries with incremental support"""
     print("Running analysis queries...")
     create_incremental_user_summary()
     create_incremental_category_summary()
     create_incremental_cart_details()
-    print("All analysis tables updated successfully!")
\ No newline at end of file
+    create_sketch_summaries()
+    print("All analysis tables updated successfully!")
+
+def submit_all_analyses():
+    """Submit all analysis queries without waiting; returns the job IDs"""
+    print("Submitting analysis queries...")
+    return [
+        create_incremental_user_summary(wait=False),
+        create_incremental_category_summary(wait=False),
+        create_incremental_cart_details(wait=False),
+        *create_sketch_summaries(wait=False),
+    ]
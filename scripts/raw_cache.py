@@ -0,0 +1,171 @@
+# Local disk cache of immutable raw GCS blobs, filled by parallel byte-range downloads
+import base64
+import hashlib
+import mmap
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from config.gcp_config import RAW_CACHE_CONFIG
+from scripts.io_control import GCS_HOST, get_io_controller
+from scripts.lazy_imports import lazy_import
+
+storage = lazy_import('google.cloud.storage')
+
+_STATS = {'hits': 0, 'misses': 0, 'bytes_downloaded': 0, 'evicted_files': 0}
+_STATS_LOCK = threading.Lock()
+_EVICT_LOCK = threading.Lock()
+
+def _count(name, amount=1):
+    with _STATS_LOCK:
+        _STATS[name] += amount
+
+def parse_gcs_path(gcs_path):
+    """Split gs://bucket/path into (bucket, path)"""
+    bucket_name, blob_path = gcs_path.replace("gs://", "").split("/", 1)
+    return bucket_name, blob_path
+
+def cache_key(blob):
+    """Cache file name for a blob version: its generation plus its MD5 (or CRC32C) checksum"""
+    checksum = blob.md5_hash or blob.crc32c or ""
+    return f"{blob.generation}-{base64.b64decode(checksum).hex()}"
+
+def cache_path(key):
+    """Path of a cache entry, fanned out over subdirectories by the checksum prefix"""
+    return os.path.join(RAW_CACHE_CONFIG['directory'], key.rsplit('-', 1)[-1][:2] or '00', key)
+
+def byte_ranges(size, range_bytes):
+    """Inclusive (start, end) byte ranges covering a blob of `size` bytes"""
+    return [(start, min(start + range_bytes, size) - 1) for start in range(0, size, range_bytes)]
+
+def download_to_file(blob, path):
+    """Download one blob version to `path`, as parallel byte ranges when it is large
+
+    Every range is pinned to the blob's generation, written at its offset, and the
+    assembled file is checked against the blob's MD5 before it is published.
+    """
+    controller = get_io_controller(GCS_HOST)
+    size = blob.size or 0
+    partial = f"{path}.{os.getpid()}.{threading.get_ident()}.part"
+    ranges = byte_ranges(size, RAW_CACHE_CONFIG['range_bytes'])
+
+    def fetch(byte_range):
+        start, end = byte_range
+        data = controller.call(blob.download_as_bytes, start=start, end=end,
+                               if_generation_match=blob.generation, checksum=None)
+        os.pwrite(fd, data, start)
+        return len(data)
+
+    fd = os.open(partial, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        try:
+            os.ftruncate(fd, size)
+            if size > RAW_CACHE_CONFIG['parallel_threshold_bytes']:
+                with ThreadPoolExecutor(max_workers=RAW_CACHE_CONFIG['max_workers']) as executor:
+                    downloaded = sum(executor.map(fetch, ranges))
+            else:
+                downloaded = sum(fetch(byte_range) for byte_range in ranges)
+        finally:
+            os.close(fd)
+
+        if downloaded != size:
+            raise IOError(f"Downloaded {downloaded} of {size} bytes of {blob.name}")
+        if blob.md5_hash:
+            digest = hashlib.md5()
+            with open(partial, 'rb') as f:
+                for block in iter(lambda: f.read(1024 * 1024), b''):
+                    digest.update(block)
+            if base64.b64encode(digest.digest()).decode('ascii') != blob.md5_hash:
+                raise IOError(f"MD5 mismatch for {blob.name} generation {blob.generation}")
+        # Publishing by rename means readers never see a partial file
+        os.replace(partial, path)
+    except BaseException:
+        # A failed range fetch or check must not leave the partial file behind
+        try:
+            os.remove(partial)
+        except FileNotFoundError:
+            pass
+        raise
+
+    _count('bytes_downloaded', downloaded)
+    print(f" Downloaded {blob.name} ({size / 1e6:.1f} MB) in {len(ranges)} range(s) to the raw cache")
+
+def evict_to_budget(keep=None):
+    """Delete the least recently used cache files (other than `keep`) until the cache fits in its size budget"""
+    with _EVICT_LOCK:
+        entries = []
+        for root, _, files in os.walk(RAW_CACHE_CONFIG['directory']):
+            for name in files:
+                path = os.path.join(root, name)
+                if name.endswith('.part') or path == keep:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for _, size, _ in entries)
+        if keep is not None and os.path.exists(keep):
+            total += os.path.getsize(keep)
+        for _, size, path in sorted(entries):
+            if total <= RAW_CACHE_CONFIG['max_bytes']:
+                break
+            try:
+                # Readers that already mapped the file keep their mapping
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            _count('evicted_files')
+
+def cached_blob_path(gcs_path, client=None):
+    """(local path of a cached copy, blob) for the current version of a GCS blob, downloading it on a miss"""
+    bucket_name, blob_path = parse_gcs_path(gcs_path)
+    client = client or storage.Client()
+    blob = get_io_controller(GCS_HOST).call(client.bucket(bucket_name).get_blob, blob_path)
+    if blob is None:
+        raise FileNotFoundError(f"{gcs_path} does not exist")
+
+    path = cache_path(cache_key(blob))
+    if os.path.exists(path):
+        # The modification time is the LRU clock
+        os.utime(path)
+        _count('hits')
+        return path, blob
+
+    _count('misses')
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    download_to_file(blob, path)
+    evict_to_budget(keep=path)
+    return path, blob
+
+@contextmanager
+def open_cached_blob(gcs_path, client=None):
+    """Memory-map the cached copy of a blob and yield (read-only memoryview of its bytes, blob)
+
+    The view is only valid inside the block; parse it there and keep the results, not the view.
+    """
+    path, blob = cached_blob_path(gcs_path, client)
+    try:
+        f = open(path, 'rb')
+    except FileNotFoundError:
+        # Evicted by another process between the lookup and the open, so fetch it again
+        path, blob = cached_blob_path(gcs_path, client)
+        f = open(path, 'rb')
+    with f:
+        if os.fstat(f.fileno()).st_size == 0:
+            yield memoryview(b""), blob
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)
+            try:
+                yield view, blob
+            finally:
+                view.release()
+
+def cache_stats():
+    """Hits, misses, downloaded bytes and evictions of the raw cache in this process"""
+    with _STATS_LOCK:
+        return dict(_STATS)
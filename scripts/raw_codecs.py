@@ -0,0 +1,191 @@
+# Serialization and compression codecs for raw snapshots, recorded in blob metadata
+import gzip
+import importlib
+import json
+import shutil
+import tempfile
+
+from config.gcp_config import RAW_CODEC
+
+# Blob metadata key naming the codec a raw snapshot was written with
+CODEC_METADATA_KEY = 'raw_codec'
+
+# Blobs written before codecs existed have no metadata and are plain JSON
+DEFAULT_CODEC = 'json'
+
+# Streamed snapshots keep up to this many encoded bytes in memory before spilling to disk
+SPOOL_MAX_BYTES = 16 * 1024 * 1024
+
+# Optional packages behind each format / compression
+OPTIONAL_PACKAGES = {
+    'orjson': 'orjson',
+    'msgpack': 'msgpack',
+    'zstd': 'zstandard',
+}
+
+_MODULES = {}
+
+def _require(name):
+    """Import the optional package behind a format or compression, with an actionable error"""
+    if name not in _MODULES:
+        package = OPTIONAL_PACKAGES[name]
+        try:
+            _MODULES[name] = importlib.import_module(package)
+        except ImportError as e:
+            raise ImportError(
+                f"Raw codec '{name}' needs the optional '{package}' package (pip install {package})"
+            ) from e
+    return _MODULES[name]
+
+def _json_encode(data):
+    return json.dumps(data).encode('utf-8')
+
+def _json_decode(buffer):
+    return json.loads(str(buffer, 'utf-8'))
+
+def _orjson_encode(data):
+    return _require('orjson').dumps(data)
+
+def _orjson_decode(buffer):
+    # orjson parses bytes-like objects, memory-mapped ones included, without copying them
+    return _require('orjson').loads(buffer)
+
+def _msgpack_encode(data):
+    return _require('msgpack').packb(data, use_bin_type=True)
+
+def _msgpack_decode(buffer):
+    return _require('msgpack').unpackb(buffer, raw=False)
+
+def _zstd_compress(payload):
+    return _require('zstd').ZstdCompressor(level=3).compress(payload)
+
+def _zstd_decompress(buffer):
+    return _require('zstd').ZstdDecompressor().decompress(buffer)
+
+# format -> (encode, decode, file extension, content type)
+FORMATS = {
+    'json': (_json_encode, _json_decode, 'json', 'application/json'),
+    'orjson': (_orjson_encode, _orjson_decode, 'json', 'application/json'),
+    'msgpack': (_msgpack_encode, _msgpack_decode, 'msgpack', 'application/msgpack'),
+}
+
+def _json_frame(encode, data_type, count):
+    # '{"users": [' ... '], "total": n, "skip": 0, "limit": n}', with records joined by ','
+    head = encode({data_type: []})[:-2]
+    tail = b"]," + encode({'total': count, 'skip': 0, 'limit': count})[1:]
+    return head, b",", tail
+
+def _msgpack_frame(data_type, count):
+    # A 4-entry map whose first value is an array of `count` concatenated records
+    packer = _require('msgpack').Packer(use_bin_type=True)
+    head = packer.pack_map_header(4) + packer.pack(data_type) + packer.pack_array_header(count)
+    tail = b"".join(packer.pack(value) for value in ('total', count, 'skip', 0, 'limit', count))
+    return head, b"", tail
+
+# format -> frame(data_type, count) returning (head, record separator, tail) of a streamed snapshot
+STREAM_FRAMES = {
+    'json': lambda data_type, count: _json_frame(_json_encode, data_type, count),
+    'orjson': lambda data_type, count: _json_frame(_orjson_encode, data_type, count),
+    'msgpack': _msgpack_frame,
+}
+
+# compression -> (compress, decompress, file extension)
+COMPRESSIONS = {
+    'gzip': (lambda payload: gzip.compress(payload, compresslevel=6), gzip.decompress, 'gz'),
+    'zstd': (_zstd_compress, _zstd_decompress, 'zst'),
+}
+
+# compression -> open a compressing writer over a file object, given the uncompressed size
+COMPRESSION_STREAMS = {
+    'gzip': lambda out, size: gzip.GzipFile(fileobj=out, mode='wb', compresslevel=6),
+    # The size goes in the frame header, which decode()'s one-shot decompress needs
+    'zstd': lambda out, size: _require('zstd').ZstdCompressor(level=3).stream_writer(out, size=size, closefd=False),
+}
+
+def parse_codec(codec):
+    """Split a codec name such as 'msgpack+zstd' into (format, compression or None)"""
+    data_format, _, compression = (codec or DEFAULT_CODEC).partition('+')
+    if data_format not in FORMATS:
+        raise ValueError(f"Unknown raw format '{data_format}' in codec '{codec}', expected one of {list(FORMATS)}")
+    if compression and compression not in COMPRESSIONS:
+        raise ValueError(f"Unknown compression '{compression}' in codec '{codec}', expected one of {list(COMPRESSIONS)}")
+    return data_format, compression or None
+
+def file_extension(codec=None):
+    """File extension of a snapshot written with the codec, e.g. 'msgpack.zst'"""
+    data_format, compression = parse_codec(codec or RAW_CODEC)
+    extension = FORMATS[data_format][2]
+    return f"{extension}.{COMPRESSIONS[compression][2]}" if compression else extension
+
+def content_type(codec=None):
+    """Content type of a snapshot written with the codec"""
+    data_format, compression = parse_codec(codec or RAW_CODEC)
+    return 'application/octet-stream' if compression else FORMATS[data_format][3]
+
+def encode(data, codec=None):
+    """Serialize (and optionally compress) a snapshot with the codec, RAW_CODEC by default"""
+    data_format, compression = parse_codec(codec or RAW_CODEC)
+    payload = FORMATS[data_format][0](data)
+    return COMPRESSIONS[compression][0](payload) if compression else payload
+
+def decode(buffer, codec=None):
+    """Decode a snapshot from any bytes-like buffer; without a codec it is plain JSON"""
+    data_format, compression = parse_codec(codec or DEFAULT_CODEC)
+    if compression:
+        buffer = COMPRESSIONS[compression][1](buffer)
+    return FORMATS[data_format][1](buffer)
+
+def blob_codec(blob):
+    """Codec recorded in a blob's metadata (plain JSON for blobs written before codecs)"""
+    return (blob.metadata or {}).get(CODEC_METADATA_KEY, DEFAULT_CODEC)
+
+class SnapshotWriter:
+    """Streams pages of records into a snapshot that decodes like encode() of
+    {data_type: records, 'total': n, 'skip': 0, 'limit': n}
+
+    Records are encoded page by page into a spool file (on disk past SPOOL_MAX_BYTES), so
+    only the current page is held in memory; finish() frames and compresses them.
+    """
+
+    def __init__(self, data_type, codec=None):
+        self.data_type = data_type
+        self.codec = codec or RAW_CODEC
+        self.format, self.compression = parse_codec(self.codec)
+        self.separator = STREAM_FRAMES[self.format](data_type, 0)[1]
+        self.count = 0
+        self.spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_BYTES)
+
+    def write(self, records):
+        """Append a page of records"""
+        encode = FORMATS[self.format][0]
+        for record in records:
+            if self.count and self.separator:
+                self.spool.write(self.separator)
+            self.spool.write(encode(record))
+            self.count += 1
+
+    def finish(self, out):
+        """Write the complete snapshot to a binary file object and return the bytes written"""
+        head, _, tail = STREAM_FRAMES[self.format](self.data_type, self.count)
+        size = len(head) + self.spool.tell() + len(tail)
+        start = out.tell()
+
+        sink = COMPRESSION_STREAMS[self.compression](out, size) if self.compression else out
+        sink.write(head)
+        self.spool.seek(0)
+        shutil.copyfileobj(self.spool, sink)
+        sink.write(tail)
+        if self.compression:
+            # Flushes the compressed trailer; `out` itself stays open
+            sink.close()
+        return out.tell() - start
+
+    def close(self):
+        self.spool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+        return False
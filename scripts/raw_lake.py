@@ -0,0 +1,131 @@
+# Helpers for the raw data lake (GCS snapshots written by extract_data)
+import json
+import re
+from datetime import datetime
+
+from config.gcp_config import COMPACTION_CONFIG, GCS_BUCKET_NAME
+from scripts.lazy_imports import lazy_import
+
+storage = lazy_import('google.cloud.storage')
+
+SNAPSHOT_TIMESTAMP_FORMAT = "%Y%m%d_%H%M%S"
+
+# raw_{data_type}/{baseline|incremental}_{YYYYmmdd_HHMMSS}.json
+SNAPSHOT_NAME_PATTERN = re.compile(r"^raw_(\w+?)/(baseline|incremental)_(\d{8}_\d{6})\.[\w.]+$")
+
+# Snapshot kinds; names of one kind sort by their timestamp
+SNAPSHOT_KINDS = ['baseline', 'incremental']
+
+def raw_prefix(data_type):
+    """GCS prefix holding the raw snapshots of an entity"""
+    return f"raw_{data_type}/"
+
+def snapshot_name_prefix(data_type, kind, timestamp=None):
+    """Blob name prefix of an entity's snapshots of one kind (taken at `timestamp` when given)"""
+    prefix = f"{raw_prefix(data_type)}{kind}_"
+    return f"{prefix}{timestamp.strftime(SNAPSHOT_TIMESTAMP_FORMAT)}" if timestamp is not None else prefix
+
+def parse_snapshot_name(blob_name):
+    """Parse a raw snapshot blob name into (data_type, kind, timestamp), or None"""
+    match = SNAPSHOT_NAME_PATTERN.match(blob_name)
+    if not match:
+        return None
+    data_type, kind, timestamp = match.groups()
+    return data_type, kind, datetime.strptime(timestamp, SNAPSHOT_TIMESTAMP_FORMAT)
+
+def list_raw_snapshots(data_type, start=None, end=None, client=None):
+    """List baseline and incremental snapshots of an entity in [start, end), oldest first
+
+    Names embed the snapshot time, so GCS only lists the blobs inside the range.
+    """
+    client = client or storage.Client()
+    snapshots = []
+    
+    for snapshot_kind in SNAPSHOT_KINDS:
+        blobs = client.list_blobs(
+            GCS_BUCKET_NAME,
+            prefix=snapshot_name_prefix(data_type, snapshot_kind),
+            start_offset=snapshot_name_prefix(data_type, snapshot_kind, start) if start is not None else None,
+            end_offset=snapshot_name_prefix(data_type, snapshot_kind, end) if end is not None else None,
+        )
+        for blob in blobs:
+            parsed = parse_snapshot_name(blob.name)
+            if parsed is None:
+                continue
+            
+            _, kind, timestamp = parsed
+            if start is not None and timestamp < start:
+                continue
+            if end is not None and timestamp >= end:
+                continue
+            
+            snapshots.append({
+                'name': blob.name,
+                'gcs_path': f"gs://{GCS_BUCKET_NAME}/{blob.name}",
+                'kind': kind,
+                'timestamp': timestamp,
+                'size': blob.size or 0,
+            })
+    
+    snapshots.sort(key=lambda snapshot: snapshot['timestamp'])
+    return snapshots
+
+def latest_raw_snapshot(data_type, before=None, client=None):
+    """The most recent snapshot of an entity taken before `before` (or at all), or None
+
+    The manifest records the newest compacted snapshot, so only snapshots from then on are listed.
+    """
+    client = client or storage.Client()
+    manifest, _ = read_manifest(data_type, client)
+    compacted = [
+        datetime.fromisoformat(entry['max_snapshot_ts']) for entry in manifest['files']
+        if before is None or datetime.fromisoformat(entry['max_snapshot_ts']) < before
+    ]
+    since = max(compacted, default=None)
+    
+    snapshots = list_raw_snapshots(data_type, start=since, end=before, client=client)
+    if not snapshots and since is not None:
+        # The compacted snapshots' JSON may have expired, so look further back
+        snapshots = list_raw_snapshots(data_type, end=before, client=client)
+    return snapshots[-1] if snapshots else None
+
+def compacted_prefix(data_type):
+    """Hive-style GCS prefix holding the compacted Parquet files of an entity"""
+    return f"{COMPACTION_CONFIG['prefix']}/data_type={data_type}/"
+
+def compacted_file_name(data_type, date):
+    """Blob name of the compacted Parquet file for one entity and day"""
+    return f"{compacted_prefix(data_type)}date={date.isoformat()}/part-0000.parquet"
+
+def manifest_name(data_type):
+    """Blob name of an entity's compaction manifest"""
+    return f"{compacted_prefix(data_type)}_manifest.json"
+
+def read_manifest(data_type, client=None):
+    """Read an entity's manifest; returns (manifest, generation) with generation 0 if missing"""
+    client = client or storage.Client()
+    blob = client.bucket(GCS_BUCKET_NAME).get_blob(manifest_name(data_type))
+    if blob is None:
+        return {'data_type': data_type, 'files': []}, 0
+    return json.loads(blob.download_as_bytes()), blob.generation
+
+def write_manifest(data_type, manifest, generation, client=None):
+    """Write an entity's manifest, failing if another writer changed it since it was read"""
+    client = client or storage.Client()
+    blob = client.bucket(GCS_BUCKET_NAME).blob(manifest_name(data_type))
+    blob.upload_from_string(
+        json.dumps(manifest, indent=2, default=str),
+        content_type='application/json',
+        if_generation_match=generation,
+    )
+
+def select_manifest_files(manifest, start=None, end=None):
+    """Manifest entries that can hold snapshots in [start, end)"""
+    selected = []
+    for entry in manifest['files']:
+        if start is not None and datetime.fromisoformat(entry['max_snapshot_ts']) < start:
+            continue
+        if end is not None and datetime.fromisoformat(entry['min_snapshot_ts']) >= end:
+            continue
+        selected.append(entry)
+    return sorted(selected, key=lambda entry: entry['min_snapshot_ts'])
@@ -0,0 +1,268 @@
+# Mergeable sketch aggregates: HyperLogLog distinct counts and t-digest quantiles, stored in GCS
+import base64
+import json
+import math
+from datetime import datetime
+
+from config.gcp_config import GCS_BUCKET_NAME, SKETCH_CONFIG
+from scripts.lazy_imports import lazy_import
+
+np = lazy_import('numpy')
+storage = lazy_import('google.cloud.storage')
+google_exceptions = lazy_import('google.api_core.exceptions')
+
+# Group key for cart lines whose user has no known city
+UNKNOWN_CITY = 'unknown'
+
+def splitmix64(values):
+    """Vectorized SplitMix64 finalizer: well-mixed 64-bit hashes of integer keys"""
+    z = np.asarray(values).astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+def bit_length(values):
+    """Vectorized int.bit_length() for uint64 arrays"""
+    values = values.copy()
+    lengths = np.zeros(len(values), dtype=np.uint8)
+    for shift in (32, 16, 8, 4, 2, 1):
+        wide = values >= (np.uint64(1) << np.uint64(shift))
+        lengths[wide] += shift
+        values[wide] >>= np.uint64(shift)
+    return lengths + (values > 0)
+
+class HyperLogLog:
+    """HyperLogLog distinct counter over integer keys; merging is an element-wise register max"""
+
+    def __init__(self, precision=None, registers=None):
+        self.precision = precision or SKETCH_CONFIG['hll_precision']
+        self.registers = registers if registers is not None else np.zeros(1 << self.precision, dtype=np.uint8)
+
+    def add(self, keys):
+        hashes = splitmix64(keys)
+        if not len(hashes):
+            return self
+        remaining_bits = 64 - self.precision
+        buckets = (hashes >> np.uint64(remaining_bits)).astype(np.int64)
+        rest = hashes & np.uint64((1 << remaining_bits) - 1)
+        # Position of the first set bit in the remaining bits (1-based)
+        ranks = (remaining_bits - bit_length(rest) + 1).astype(np.uint8)
+        np.maximum.at(self.registers, buckets, ranks)
+        return self
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError(f"Cannot merge HyperLogLog sketches of precision {self.precision} and {other.precision}")
+        np.maximum(self.registers, other.registers, out=self.registers)
+        return self
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / np.sum(np.exp2(-self.registers.astype(np.float64)))
+        zeros = int(np.count_nonzero(self.registers == 0))
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small cardinalities
+            estimate = m * math.log(m / zeros)
+        return int(round(estimate))
+
+    def to_dict(self):
+        return {
+            'precision': self.precision,
+            'registers': base64.b64encode(self.registers.tobytes()).decode('ascii'),
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        registers = np.frombuffer(base64.b64decode(data['registers']), dtype=np.uint8).copy()
+        return cls(data['precision'], registers)
+
+class TDigest:
+    """Merging t-digest for quantiles; centroids are bounded by the k1 scale function
+
+    Adding and merging both re-cluster all centroids in one vectorized pass, so any
+    number of digests can be combined in any order.
+    """
+
+    def __init__(self, compression=None, means=None, weights=None, minimum=None, maximum=None):
+        self.compression = compression or SKETCH_CONFIG['tdigest_compression']
+        self.means = np.asarray(means if means is not None else [], dtype=np.float64)
+        self.weights = np.asarray(weights if weights is not None else [], dtype=np.float64)
+        self.min = minimum
+        self.max = maximum
+
+    def count(self):
+        return float(self.weights.sum())
+
+    def _compress(self, means, weights):
+        order = np.argsort(means, kind='mergesort')
+        means, weights = means[order], weights[order]
+        total = weights.sum()
+
+        # Centroids may span at most one unit of k(q) = d/(2*pi) * asin(2q - 1)
+        q = (np.cumsum(weights) - weights / 2) / total
+        k = self.compression / (2 * math.pi) * np.arcsin(np.clip(2 * q - 1, -1, 1))
+        clusters = np.floor(k)
+        starts = np.flatnonzero(np.r_[True, clusters[1:] != clusters[:-1]])
+
+        self.weights = np.add.reduceat(weights, starts)
+        self.means = np.add.reduceat(means * weights, starts) / self.weights
+
+    def add(self, values, weights=None):
+        values = np.asarray(values, dtype=np.float64)
+        weights = np.ones(len(values)) if weights is None else np.asarray(weights, dtype=np.float64)
+        present = ~np.isnan(values)
+        values, weights = values[present], weights[present]
+        if not len(values):
+            return self
+        self.min = float(values.min()) if self.min is None else min(self.min, float(values.min()))
+        self.max = float(values.max()) if self.max is None else max(self.max, float(values.max()))
+        self._compress(np.concatenate([self.means, values]), np.concatenate([self.weights, weights]))
+        return self
+
+    def merge(self, other):
+        if not other.count():
+            return self
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        self._compress(np.concatenate([self.means, other.means]), np.concatenate([self.weights, other.weights]))
+        return self
+
+    def quantile(self, q):
+        """Estimated q-quantile, interpolating between centroid centres (exact at min and max)"""
+        total = self.count()
+        if not total:
+            return None
+        centres = np.cumsum(self.weights) - self.weights / 2
+        positions = np.r_[0.0, centres, total]
+        values = np.r_[self.min, self.means, self.max]
+        return float(np.interp(q * total, positions, values))
+
+    def to_dict(self):
+        return {
+            'compression': self.compression,
+            'means': self.means.tolist(),
+            'weights': self.weights.tolist(),
+            'min': self.min,
+            'max': self.max,
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data['compression'], data['means'], data['weights'], data['min'], data['max'])
+
+# Sketch families in the stored state: name -> sketch class
+SKETCH_TYPES = {
+    'distinct_buyers_by_category': HyperLogLog,
+    'quantity_by_category': TDigest,
+    'cart_value_by_city': TDigest,
+}
+
+def empty_sketch_state():
+    return {'max_cart_id': 0, 'updated_at': None, **{name: {} for name in SKETCH_TYPES}}
+
+def read_sketch_state(client=None):
+    """Read the stored sketch state; returns (state with sketch objects, generation) with generation 0 if missing"""
+    client = client or storage.Client()
+    blob = client.bucket(GCS_BUCKET_NAME).get_blob(SKETCH_CONFIG['path'])
+    if blob is None:
+        return empty_sketch_state(), 0
+
+    stored = json.loads(blob.download_as_bytes())
+    state = {'max_cart_id': stored['max_cart_id'], 'updated_at': stored['updated_at']}
+    for name, sketch_type in SKETCH_TYPES.items():
+        state[name] = {key: sketch_type.from_dict(data) for key, data in stored.get(name, {}).items()}
+    return state, blob.generation
+
+def write_sketch_state(state, generation, client=None):
+    """Write the sketch state, failing if another writer changed it since it was read"""
+    client = client or storage.Client()
+    stored = {'max_cart_id': state['max_cart_id'], 'updated_at': state['updated_at']}
+    for name in SKETCH_TYPES:
+        stored[name] = {key: sketch.to_dict() for key, sketch in state[name].items()}
+
+    blob = client.bucket(GCS_BUCKET_NAME).blob(SKETCH_CONFIG['path'])
+    blob.upload_from_string(json.dumps(stored), content_type='application/json', if_generation_match=generation)
+
+def build_cart_sketches(df, cities):
+    """Sketches of one carts batch: distinct buyers and line quantities per category, cart value per city"""
+    batch = {name: {} for name in SKETCH_TYPES}
+
+    categorized = df[df['category'].notna()]
+    for category, lines in categorized.groupby(categorized['category'].astype(str)):
+        batch['distinct_buyers_by_category'][category] = HyperLogLog().add(lines['user_id'].to_numpy(dtype='int64'))
+        batch['quantity_by_category'][category] = TDigest().add(lines['quantity'].to_numpy())
+
+    # total_cart_value repeats on every line of a cart, so count each cart once
+    carts = df.assign(city=cities).drop_duplicates('cart_id')
+    carts['city'] = carts['city'].fillna(UNKNOWN_CITY).astype(str)
+    for city, city_carts in carts.groupby('city'):
+        batch['cart_value_by_city'][city] = TDigest().add(city_carts['total_cart_value'].to_numpy())
+
+    return batch
+
+def merge_sketches(state, batch):
+    """Merge a batch's sketches into the state, key by key"""
+    for name, sketches in batch.items():
+        for key, sketch in sketches.items():
+            if key in state[name]:
+                state[name][key].merge(sketch)
+            else:
+                state[name][key] = sketch
+    return state
+
+def update_cart_sketches(df, cities, client=None):
+    """Fold a transformed carts batch into the stored sketches
+
+    Carts at or below the state's max_cart_id were folded in by an earlier run, so a
+    retried transform does not count them twice. Concurrent writers are resolved by
+    re-reading and re-merging when the generation precondition fails.
+    """
+    if df is None or df.empty:
+        return None
+
+    client = client or storage.Client()
+    for attempt in range(SKETCH_CONFIG['write_attempts']):
+        state, generation = read_sketch_state(client)
+        new_lines = (df['cart_id'] > state['max_cart_id']).to_numpy()
+        if not new_lines.any():
+            print("Sketches already include every cart in this batch")
+            return state
+
+        batch = build_cart_sketches(df[new_lines], np.asarray(cities, dtype=object)[new_lines])
+        state = merge_sketches(state, batch)
+        state['max_cart_id'] = int(df['cart_id'].max())
+        state['updated_at'] = datetime.now().isoformat()
+        try:
+            write_sketch_state(state, generation, client)
+            print(f"Folded {int(new_lines.sum())} cart lines into the sketches (max cart_id {state['max_cart_id']})")
+            return state
+        except google_exceptions.PreconditionFailed:
+            print(f"Sketch state changed concurrently, retrying ({attempt + 1}/{SKETCH_CONFIG['write_attempts']})")
+
+    raise RuntimeError("Could not update the sketch state after concurrent modifications")
+
+def rebuild_cart_sketches(df, cities, client=None):
+    """Replace the stored sketches with sketches of a replayed carts frame
+
+    Used by backfills, whose carts can sit at or below the stored max_cart_id and would
+    never be folded in by update_cart_sketches. The write is conditioned on the generation
+    read first, so an update made during the rebuild fails it instead of being overwritten.
+    """
+    if df is None or df.empty:
+        return None
+
+    client = client or storage.Client()
+    blob = client.bucket(GCS_BUCKET_NAME).get_blob(SKETCH_CONFIG['path'])
+    generation = blob.generation if blob is not None else 0
+
+    state = merge_sketches(empty_sketch_state(), build_cart_sketches(df, np.asarray(cities, dtype=object)))
+    state['max_cart_id'] = int(df['cart_id'].max())
+    state['updated_at'] = datetime.now().isoformat()
+    try:
+        write_sketch_state(state, generation, client)
+    except google_exceptions.PreconditionFailed:
+        raise RuntimeError("Sketch state changed during the rebuild, run the backfill again") from None
+
+    print(f"Rebuilt the sketches from {len(df)} cart lines (max cart_id {state['max_cart_id']})")
+    return state
@@ -1,49 +1,69 @@
-# Import the necessary libraries
-import pandas as pd
-import json
+# Import the necessary libraries (heavy ones are loaded lazily on first use)
 from datetime import datetime
-from google.cloud import storage, bigquery
-
-# Import configuration with error handling
-try:
-    from config.gcp_config import *
-except ImportError:
-    # Fallback for when running directly or in VSCode
-    import sys
-    import os
-    # Add project root to path
-    project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
-    if project_root not in sys.path:
-        sys.path.append(project_root)
-    from config.gcp_config import *
+
+from config.gcp_config import (
+    BQ_CLEAN_CARTS_TABLE,
+    BQ_CLEAN_PRODUCTS_TABLE,
+    BQ_CLEAN_USERS_TABLE,
+    BQ_DATASET,
+    GCP_PROJECT_ID,
+)
+from scripts import raw_codecs
+from scripts.io_control import GCS_HOST, get_io_controller
+from scripts.lazy_imports import lazy_import
+from scripts.memory_budget import chunk_size, iter_chunks, print_memory_report, track_stage
+from scripts.raw_cache import cache_stats, open_cached_blob, parse_gcs_path
+from scripts.raw_lake import latest_raw_snapshot
+from scripts.sketches import update_cart_sketches
+from scripts.validate_data import validate_and_quarantine, validate_dataframe
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
+storage = lazy_import('google.cloud.storage')
+bigquery = lazy_import('google.cloud.bigquery')
+
+# Low-cardinality string columns stored as pandas categoricals (Arrow/Parquet dictionaries)
+CATEGORICAL_COLUMNS = {
+    'users': ['gender', 'city'],
+    'products': ['category', 'brand'],
+    'carts': ['category', 'brand'],
+}
+
+# Products at or below this price are filtered out of products_table
+MIN_PRODUCT_PRICE = 50
+
+# Product attributes denormalized onto every cart line
+CART_PRODUCT_ATTRIBUTES = ['category', 'brand']
+
+def encode_categoricals(df, data_type):
+    """Dictionary-encode an entity's low-cardinality string columns in place and return the frame
+
+    Chunked transforms and concatenations fall back to object dtype when categories
+    differ, so this runs once on the final frame.
+    """
+    for column in CATEGORICAL_COLUMNS[data_type]:
+        if column in df.columns:
+            df[column] = df[column].astype('category')
+    return df
 
 def get_max_ids_from_target():
-    """Get maximum IDs from target tables for incremental processing"""
+    """Get maximum IDs from target tables for incremental processing (one query for all tables)"""
     try:
         client = bigquery.Client(project=GCP_PROJECT_ID)
         
-        max_ids = {}
-        
-        query = f"SELECT COALESCE(MAX(user_id), 0) as max_id FROM `{GCP_PROJECT_ID}.{BQ_DATASET}.{BQ_CLEAN_USERS_TABLE}`"
-        result = client.query(query).result()
-        for row in result:
-            max_ids['users'] = row.max_id
-        
-        query = f"SELECT COALESCE(MAX(product_id), 0) as max_id FROM `{GCP_PROJECT_ID}.{BQ_DATASET}.{BQ_CLEAN_PRODUCTS_TABLE}`"
-        result = client.query(query).result()
-        for row in result:
-            max_ids['products'] = row.max_id
-            
-        query = f"SELECT COALESCE(MAX(cart_id), 0) as max_id FROM `{GCP_PROJECT_ID}.{BQ_DATASET}.{BQ_CLEAN_CARTS_TABLE}`"
-        result = client.query(query).result()
-        for row in result:
-            max_ids['carts'] = row.max_id
-            
-        return max_ids
+        query = f"""
+        SELECT
+            (SELECT COALESCE(MAX(user_id), 0) FROM `{GCP_PROJECT_ID}.{BQ_DATASET}.{BQ_CLEAN_USERS_TABLE}`) AS users,
+            (SELECT COALESCE(MAX(product_id), 0) FROM `{GCP_PROJECT_ID}.{BQ_DATASET}.{BQ_CLEAN_PRODUCTS_TABLE}`) AS products,
+            (SELECT COALESCE(MAX(cart_id), 0) FROM `{GCP_PROJECT_ID}.{BQ_DATASET}.{BQ_CLEAN_CARTS_TABLE}`) AS carts
+        """
+        # The transform needs the watermarks before it can start, so this short query is waited on
+        for row in client.query(query).result():
+            return {'users': row.users, 'products': row.products, 'carts': row.carts}
         
     except Exception as e:
         print(f"Error getting max IDs: {e}")
-        return {'users': 0, 'products': 0, 'carts': 0}
+    return {'users': 0, 'products': 0, 'carts': 0}
 
 def transform_users_data(raw_data, max_user_id):
     """Transform and clean users data with incremental logic"""
@@ -52,26 +72,38 @@ def transform_users_data(raw_data, max_user_id):
         
         if not users_list:
             return pd.DataFrame()
-            
-        df = pd.json_normalize(users_list)
         
-        df = df[df['id'] > max_user_id]
+        chunks = []
         
-        if df.empty:
+        # Normalize in budget-sized chunks rather than the whole payload at once
+        with track_stage('transform_users') as tracker:
+            for users_chunk in iter_chunks(users_list, chunk_size('transform_users')):
+                df = pd.json_normalize(users_chunk)
+                
+                df = df[df['id'] > max_user_id]
+                
+                if df.empty:
+                    continue
+                
+                # .get keeps a chunk working when none of its records has an optional field
+                chunks.append(pd.DataFrame({
+                    'user_id': df['id'],
+                    'first_name': df.get('firstName'),
+                    'last_name': df.get('lastName'),
+                    'gender': df.get('gender'),
+                    'age': df.get('age'),
+                    'street': df.get('address.address'),
+                    'city': df.get('address.city'),
+                    'postal_code': df.get('address.postalCode'),
+                    'load_timestamp': datetime.now()
+                }))
+            tracker.records = len(users_list)
+        
+        if not chunks:
             print("No new user records to transform")
             return pd.DataFrame()
         
-        users_clean = pd.DataFrame({
-            'user_id': df['id'],
-            'first_name': df['firstName'],
-            'last_name': df['lastName'],
-            'gender': df['gender'],
-            'age': df['age'],
-            'street': df['address.address'],
-            'city': df['address.city'],
-            'postal_code': df['address.postalCode'],
-            'load_timestamp': datetime.now()
-        })
+        users_clean = encode_categoricals(pd.concat(chunks, ignore_index=True), 'users')
         
         print(f"Transformed {len(users_clean)} new user records")
         return users_clean
@@ -87,23 +119,35 @@ def transform_products_data(raw_data, max_product_id):
         
         if not products_list:
             return pd.DataFrame()
-            
-        df = pd.json_normalize(products_list)
         
-        df = df[(df['id'] > max_product_id) & (df['price'] > 50)]
+        chunks = []
         
-        if df.empty:
+        # Normalize in budget-sized chunks rather than the whole payload at once
+        with track_stage('transform_products') as tracker:
+            for products_chunk in iter_chunks(products_list, chunk_size('transform_products')):
+                df = pd.json_normalize(products_chunk)
+                
+                df = df[(df['id'] > max_product_id) & (df['price'] > MIN_PRODUCT_PRICE)]
+                
+                if df.empty:
+                    continue
+                
+                # .get keeps a chunk working when none of its records has an optional field
+                chunks.append(pd.DataFrame({
+                    'product_id': df['id'],
+                    'name': df.get('title'),
+                    'category': df.get('category'),
+                    'brand': df.get('brand'),
+                    'price': df['price'],
+                    'load_timestamp': datetime.now()
+                }))
+            tracker.records = len(products_list)
+        
+        if not chunks:
             print("No new product records to transform")
             return pd.DataFrame()
         
-        products_clean = pd.DataFrame({
-            'product_id': df['id'],
-            'name': df['title'],
-            'category': df['category'],
-            'brand': df['brand'],
-            'price': df['price'],
-            'load_timestamp': datetime.now()
-        })
+        products_clean = encode_categoricals(pd.concat(chunks, ignore_index=True), 'products')
         
         print(f"Transformed {len(products_clean)} new product records")
         return products_clean
@@ -112,40 +156,128 @@ def transform_products_data(raw_data, max_product_id):
         print(f"Error transforming products data: {e}")
         raise
 
-def transform_carts_data(raw_data, max_cart_id):
-    """Transform and clean carts data with incremental logic"""
+def build_dimension_index(df, key, attributes):
+    """Dimension index: sorted `key` values with aligned attribute arrays, for vectorized lookups by ID
+
+    `attributes` maps attribute names to the columns of `df` holding them.
+    """
+    df = df.drop_duplicates(key, keep='last').sort_values(key)
+    index = {'ids': df[key].to_numpy(dtype='int64')}
+    for attribute, column in attributes.items():
+        index[attribute] = df.get(column, pd.Series(None, index=df.index)).to_numpy(dtype=object)
+    return index
+
+def lookup_dimension(index, keys, attribute):
+    """Attribute values for `keys` found with a vectorized binary search; None where a key is missing"""
+    keys = pd.to_numeric(pd.Series(keys), errors='coerce').fillna(-1).to_numpy(dtype='int64')
+    if index is None or len(index['ids']) == 0:
+        return np.full(len(keys), None, dtype=object)
+    
+    ids = index['ids']
+    positions = np.searchsorted(ids, keys).clip(max=len(ids) - 1)
+    return np.where(ids[positions] == keys, index[attribute][positions], None)
+
+def build_product_index(raw_data):
+    """Product dimension index from a full products snapshot
+
+    Indexes the rows products_table would hold: the products transform (price filter
+    included) followed by validation, so carts never pick up the category or brand of
+    a product that was filtered out or quarantined.
+    """
+    products, _ = validate_dataframe(transform_products_data(raw_data, 0), 'products')
+    if products.empty:
+        return None
+    
+    index = build_dimension_index(products, 'product_id', {attribute: attribute for attribute in CART_PRODUCT_ATTRIBUTES})
+    print(f"Built product index with {len(index['ids'])} products")
+    return index
+
+def build_user_index(raw_data):
+    """User dimension index (city) from a full users snapshot, over the rows that pass validation"""
+    users, _ = validate_dataframe(transform_users_data(raw_data, 0), 'users')
+    if users.empty:
+        return None
+    
+    index = build_dimension_index(users, 'user_id', {'city': 'city'})
+    print(f"Built user index with {len(index['ids'])} users")
+    return index
+
+DIMENSION_INDEX_BUILDERS = {
+    'products': build_product_index,
+    'users': build_user_index,
+}
+
+def load_dimension_index(data_type, gcs_path=None, before=None):
+    """Dimension index from the given snapshot, or the latest one of the entity in the raw lake"""
+    if gcs_path is None:
+        snapshot = latest_raw_snapshot(data_type, before=before)
+        if snapshot is None:
+            print(f"No {data_type} snapshot found, lookups against it will return nulls")
+            return None
+        gcs_path = snapshot['gcs_path']
+    
+    return DIMENSION_INDEX_BUILDERS[data_type](load_json_from_gcs(gcs_path))
+
+def enrich_carts(df, product_index):
+    """Attach product attributes to every cart line by product_id
+
+    Lines whose product is not in the index (unknown, or filtered out by price) get nulls.
+    """
+    for attribute in CART_PRODUCT_ATTRIBUTES:
+        df[attribute] = lookup_dimension(product_index, df['product_id'], attribute)
+    return df
+
+def update_sketches(df, user_index):
+    """Fold a validated carts batch into the stored sketches; failures only skip the sketch update"""
+    try:
+        update_cart_sketches(df, lookup_dimension(user_index, df['user_id'], 'city'))
+    except Exception as e:
+        print(f"Could not update the cart sketches: {e}")
+
+def transform_carts_data(raw_data, max_cart_id, product_index=None):
+    """Transform and clean carts data with incremental logic, enriched with product attributes"""
     try:
         carts_list = raw_data.get('carts', [])
         
         if not carts_list:
             return pd.DataFrame()
-            
-        exploded_data = []
         
-        for cart in carts_list:
-            if cart['id'] <= max_cart_id:
-                continue
+        chunks = []
+        
+        # Explode in budget-sized chunks so only one chunk of row dicts is alive at a time
+        with track_stage('transform_carts') as tracker:
+            for carts_chunk in iter_chunks(carts_list, chunk_size('transform_carts')):
+                exploded_data = []
                 
-            cart_id = cart['id']
-            user_id = cart['userId']
-            total = cart['total']
-            
-            for product in cart['products']:
-                exploded_data.append({
-                    'cart_id': cart_id,
-                    'user_id': user_id,
-                    'product_id': product['id'],
-                    'quantity': product['quantity'],
-                    'price': product['price'],
-                    'total_cart_value': total,
-                    'load_timestamp': datetime.now()
-                })
+                for cart in carts_chunk:
+                    if cart['id'] <= max_cart_id:
+                        continue
+                        
+                    cart_id = cart['id']
+                    user_id = cart['userId']
+                    total = cart['total']
+                    
+                    for product in cart['products']:
+                        exploded_data.append({
+                            'cart_id': cart_id,
+                            'user_id': user_id,
+                            'product_id': product['id'],
+                            'quantity': product['quantity'],
+                            'price': product['price'],
+                            'total_cart_value': total,
+                            'load_timestamp': datetime.now()
+                        })
+                
+                if exploded_data:
+                    chunks.append(pd.DataFrame(exploded_data))
+            tracker.records = len(carts_list)
         
-        if not exploded_data:
+        if not chunks:
             print("No new cart records to transform")
             return pd.DataFrame()
             
-        carts_clean = pd.DataFrame(exploded_data)
+        carts_clean = enrich_carts(pd.concat(chunks, ignore_index=True), product_index)
+        carts_clean = encode_categoricals(carts_clean, 'carts')
         print(f"Transformed {len(carts_clean)} new cart product records")
         return carts_clean
         
@@ -153,47 +285,85 @@ def transform_carts_data(raw_data, max_cart_id):
         print(f"Error transforming carts data: {e}")
         raise
 
+def transform_entity_data(data_type, extraction_result, max_ids=None, dimension_indexes=None, dimension_paths=None):
+    """Transform a single extracted dataset with incremental logic
+
+    Carts are enriched from the products index and folded into the sketches by user city.
+    Indexes missing from `dimension_indexes` are built from this run's snapshots in
+    `dimension_paths` (entity -> gcs_path), or else from the latest snapshots in the raw lake.
+    """
+    if max_ids is None:
+        max_ids = get_max_ids_from_target()
+    dimension_indexes = dict(dimension_indexes or {})
+    
+    raw_data = load_json_from_gcs(extraction_result['gcs_path'])
+    
+    if data_type == 'users':
+        df = transform_users_data(raw_data, max_ids['users'])
+    elif data_type == 'products':
+        df = transform_products_data(raw_data, max_ids['products'])
+    elif data_type == 'carts':
+        for dimension in DIMENSION_INDEX_BUILDERS:
+            if dimension not in dimension_indexes:
+                dimension_indexes[dimension] = load_dimension_index(dimension, (dimension_paths or {}).get(dimension))
+        df = transform_carts_data(raw_data, max_ids['carts'], dimension_indexes['products'])
+    else:
+        raise ValueError(f"Unknown data type: {data_type}")
+    
+    # Catch rows BigQuery would reject before paying for the upload
+    df = validate_and_quarantine(df, data_type)
+    if data_type == 'carts' and df is not None and not df.empty:
+        update_sketches(df, dimension_indexes['users'])
+    return df
+
 def transform_all_data(extraction_results):
     """Transform all datasets with incremental logic"""
     transformed_data = {}
     
     max_ids = get_max_ids_from_target()
     
+    # Carts use this run's products and users snapshots when they were extracted
+    dimension_paths = {
+        dimension: extraction_results[dimension]['gcs_path']
+        for dimension in DIMENSION_INDEX_BUILDERS
+        if extraction_results.get(dimension, {}).get('gcs_path')
+    }
+    
     for data_type, result in extraction_results.items():
         if 'error' in result:
             print(f"Skipping {data_type} due to previous error")
             continue
             
         try:
-            raw_data = load_json_from_gcs(result['gcs_path'])
-            
-            if data_type == 'users':
-                transformed_data[data_type] = transform_users_data(raw_data, max_ids['users'])
-            elif data_type == 'products':
-                transformed_data[data_type] = transform_products_data(raw_data, max_ids['products'])
-            elif data_type == 'carts':
-                transformed_data[data_type] = transform_carts_data(raw_data, max_ids['carts'])
+            transformed_data[data_type] = transform_entity_data(data_type, result, max_ids, dimension_paths=dimension_paths)
                 
         except Exception as e:
             print(f"Failed to transform {data_type} data: {e}")
             transformed_data[data_type] = None
     
+    print_memory_report()
+    print(f"Raw cache: {cache_stats()}")
     return transformed_data
 
-def load_json_from_gcs(gcs_path):
-    """Load JSON data from GCS"""
+def load_json_from_gcs(gcs_path, client=None):
+    """Load a raw snapshot from GCS through the local raw blob cache, decoding it with its recorded codec"""
     try:
-        path_parts = gcs_path.replace("gs://", "").split("/", 1)
-        bucket_name = path_parts[0]
-        blob_path = path_parts[1]
+        try:
+            with open_cached_blob(gcs_path, client) as (data, blob):
+                # Decodes straight from the memory-mapped file
+                return raw_codecs.decode(data, raw_codecs.blob_codec(blob))
+        except OSError as e:
+            print(f"Raw cache unavailable for {gcs_path} ({e}), downloading directly")
         
-        client = storage.Client()
-        bucket = client.bucket(bucket_name)
-        blob = bucket.blob(blob_path)
+        bucket_name, blob_path = parse_gcs_path(gcs_path)
+        client = client or storage.Client()
+        controller = get_io_controller(GCS_HOST)
+        blob = controller.call(client.bucket(bucket_name).get_blob, blob_path)
+        if blob is None:
+            raise FileNotFoundError(f"{gcs_path} does not exist")
         
-        json_data = json.loads(blob.download_as_string())
-        return json_data
+        return raw_codecs.decode(controller.call(blob.download_as_bytes), raw_codecs.blob_codec(blob))
         
     except Exception as e:
         print(f"Error loading from GCS {gcs_path}: {e}")
-        raise
\ No newline at end of file
+        raise
@@ -0,0 +1,135 @@
+# Vectorized pre-load validation of transformed data, with a quarantine output
+import io
+from datetime import datetime
+
+from config.gcp_config import GCS_BUCKET_NAME, GCS_QUARANTINE_PATH
+from scripts.lazy_imports import lazy_import
+from scripts.load_data import get_clean_table_schemas
+
+pd = lazy_import('pandas')
+storage = lazy_import('google.cloud.storage')
+
+REASONS_COLUMN = 'quarantine_reasons'
+
+# Checks applied per BigQuery field type to the REQUIRED fields of the clean table schemas
+# (load_data.get_clean_table_schemas), so rows that BigQuery would reject are caught
+# before anything is uploaded
+FIELD_TYPE_CHECKS = {
+    'STRING': 'string',
+    'INTEGER': 'integer',
+    'FLOAT': 'float',
+    'TIMESTAMP': 'timestamp',
+}
+
+# Value ranges (inclusive, None for unbounded) the schemas cannot express
+VALUE_RANGES = {
+    'users': {'user_id': (1, None), 'age': (0, 130)},
+    'products': {'product_id': (1, None), 'price': (0, None)},
+    'carts': {'cart_id': (1, None), 'quantity': (1, None), 'price': (0, None), 'total_cart_value': (0, None)},
+}
+
+def validation_rules(data_type):
+    """Column lists per check, derived from the REQUIRED fields of the entity's clean table schema"""
+    rules = {check: [] for check in FIELD_TYPE_CHECKS.values()}
+    for field in get_clean_table_schemas()[data_type]:
+        if field.mode == 'REQUIRED' and field.field_type in FIELD_TYPE_CHECKS:
+            rules[FIELD_TYPE_CHECKS[field.field_type]].append(field.name)
+    rules['ranges'] = VALUE_RANGES[data_type]
+    return rules
+
+def _flag(reasons, mask, reason):
+    """Append a reason to every row selected by a boolean mask"""
+    return reasons.mask(mask, reasons + f"{reason};")
+
+def validate_dataframe(df, data_type):
+    """Split a transformed DataFrame into (valid rows, quarantined rows with reasons)
+
+    All checks are column-wise boolean masks: nulls/blanks in REQUIRED columns,
+    numeric and integral types, and value ranges.
+    """
+    rules = validation_rules(data_type)
+    reasons = pd.Series("", index=df.index, dtype=object)
+    numeric = {}
+
+    for column in rules['string'] + rules['integer'] + rules['float'] + rules['timestamp']:
+        if column not in df.columns:
+            reasons = reasons + f"{column}:missing_column;"
+
+    for column in rules['string']:
+        if column in df.columns:
+            values = df[column]
+            blank = values.isna() | (values.astype('string').str.strip() == "")
+            reasons = _flag(reasons, blank.fillna(True), f"{column}:null")
+
+    for column in rules['integer'] + rules['float']:
+        if column not in df.columns:
+            continue
+        values = pd.to_numeric(df[column], errors='coerce')
+        numeric[column] = values
+        reasons = _flag(reasons, df[column].isna(), f"{column}:null")
+        reasons = _flag(reasons, df[column].notna() & values.isna(), f"{column}:not_numeric")
+        if column in rules['integer']:
+            reasons = _flag(reasons, values.notna() & (values % 1 != 0), f"{column}:not_integer")
+
+    for column in rules['timestamp']:
+        if column in df.columns:
+            reasons = _flag(reasons, df[column].isna(), f"{column}:null")
+
+    for column, (low, high) in rules['ranges'].items():
+        if column not in numeric:
+            continue
+        values = numeric[column]
+        if low is not None:
+            reasons = _flag(reasons, values < low, f"{column}:below_{low}")
+        if high is not None:
+            reasons = _flag(reasons, values > high, f"{column}:above_{high}")
+
+    invalid = reasons != ""
+    valid_df = df[~invalid].copy()
+    for column in rules['integer']:
+        if column in valid_df.columns:
+            valid_df[column] = numeric[column][~invalid].astype('int64')
+    for column in rules['float']:
+        if column in valid_df.columns:
+            valid_df[column] = numeric[column][~invalid].astype('float64')
+
+    quarantine_df = df[invalid].copy()
+    quarantine_df[REASONS_COLUMN] = reasons[invalid].str.rstrip(";")
+    return valid_df, quarantine_df
+
+def write_quarantine(quarantine_df, data_type, timestamp=None):
+    """Write quarantined rows and their reasons to GCS as Parquet"""
+    timestamp = timestamp or datetime.now().strftime("%Y%m%d_%H%M%S")
+    filename = f"{GCS_QUARANTINE_PATH}{data_type}/quarantine_{timestamp}.parquet"
+
+    buffer = io.BytesIO()
+    # Quarantined values can have mixed types, so store them as strings
+    quarantine_df.astype('string').to_parquet(buffer, index=False)
+
+    client = storage.Client()
+    blob = client.bucket(GCS_BUCKET_NAME).blob(filename)
+    blob.upload_from_string(buffer.getvalue(), content_type='application/octet-stream')
+
+    print(f"Quarantined {len(quarantine_df)} {data_type} rows to gs://{GCS_BUCKET_NAME}/{filename}")
+    return f"gs://{GCS_BUCKET_NAME}/{filename}"
+
+def validate_and_quarantine(df, data_type):
+    """Validate a transformed DataFrame, quarantine bad rows and return only the valid ones"""
+    if df is None or df.empty:
+        return df
+
+    valid_df, quarantine_df = validate_dataframe(df, data_type)
+
+    if not quarantine_df.empty:
+        summary = quarantine_df[REASONS_COLUMN].str.split(";").explode().value_counts()
+        print(f"Validation rejected {len(quarantine_df)} of {len(df)} {data_type} rows:")
+        for reason, count in summary.items():
+            print(f"   {reason}: {count}")
+        try:
+            write_quarantine(quarantine_df, data_type)
+        except Exception as e:
+            # Still load the valid rows even if the quarantine copy could not be written
+            print(f"Could not write {data_type} quarantine output: {e}")
+
+    print(f"Validation passed {len(valid_df)} of {len(df)} {data_type} rows")
+    return valid_df
@@ -0,0 +1,26 @@
+# Import-time budget of every pipeline module (see benchmarks/import_time.py)
+import importlib.util
+import statistics
+
+import pytest
+
+from benchmarks.import_time import (
+    IMPORT_TIME_BUDGET_MS,
+    MODULES,
+    PRELOADED,
+    eagerly_loaded,
+    measure_import_ms,
+)
+
+# Fewer fresh-interpreter runs than the benchmark, to keep the suite quick
+RUNS = 3
+
+@pytest.mark.parametrize('module', MODULES)
+def test_module_import_is_lazy_and_within_budget(module):
+    for dependency in PRELOADED.get(module, []):
+        if importlib.util.find_spec(dependency) is None:
+            pytest.skip(f"{module} needs {dependency}, which is not installed")
+
+    assert eagerly_loaded(module) == []
+    median_ms = statistics.median(measure_import_ms(module) for _ in range(RUNS))
+    assert median_ms <= IMPORT_TIME_BUDGET_MS, f"{module} took {median_ms:.1f} ms to import"
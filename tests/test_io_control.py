@@ -0,0 +1,98 @@
+# Retries, Retry-After and AIMD behaviour of the I/O controller against a scripted local server
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from benchmarks.io_control_stub import get_json
+from config.gcp_config import IO_CONTROL_CONFIG
+from scripts.io_control import IOController
+
+class ScriptedHandler(BaseHTTPRequestHandler):
+    """Answers each GET with the next scripted (status, headers) pair, then with 200s"""
+
+    def do_GET(self):
+        with self.server.lock:
+            self.server.requests += 1
+            status, headers = self.server.script.pop(0) if self.server.script else (200, {})
+
+        body = b'{"ok": true}' if status == 200 else b''
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+@pytest.fixture
+def scripted_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ScriptedHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.script = []
+    server.requests = 0
+    server.url = f"http://127.0.0.1:{server.server_address[1]}/"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+def make_controller(**overrides):
+    config = {
+        **IO_CONTROL_CONFIG['default'],
+        'rate_per_second': 1000,
+        'burst': 1000,
+        'initial_concurrency': 8,
+        'target_latency_seconds': 0.05,
+        'backoff_base_seconds': 0.001,
+        'backoff_max_seconds': 0.01,
+        'max_attempts': 5,
+        **overrides,
+    }
+    return IOController('test', config)
+
+def test_retries_throttling_and_server_errors(scripted_server):
+    scripted_server.script = [(429, {}), (503, {}), (500, {})]
+    controller = make_controller()
+
+    assert controller.call(get_json, scripted_server.url, 5) == {'ok': True}
+    assert scripted_server.requests == 4
+    stats = controller.stats()
+    assert stats['retries'] == 3
+    assert stats['throttled'] == 2
+    assert stats['failures'] == 0
+
+def test_client_errors_are_not_retried(scripted_server):
+    scripted_server.script = [(404, {})]
+    controller = make_controller()
+
+    with pytest.raises(Exception):
+        controller.call(get_json, scripted_server.url, 5)
+    assert scripted_server.requests == 1
+    assert controller.stats()['failures'] == 1
+
+def test_retry_after_is_honoured(scripted_server):
+    scripted_server.script = [(429, {'Retry-After': '0.3'})]
+    controller = make_controller()
+
+    started = time.monotonic()
+    controller.call(get_json, scripted_server.url, 5)
+    # Backoff alone would wait at most backoff_max_seconds (0.01s)
+    assert time.monotonic() - started >= 0.3
+
+def test_throttling_shrinks_the_concurrency_limit(scripted_server):
+    scripted_server.script = [(429, {})]
+    controller = make_controller(initial_concurrency=8)
+
+    controller.call(get_json, scripted_server.url, 5)
+    # Multiplicative decrease on the 429, then only an additive +1/limit for the success
+    assert controller.limiter.limit < 5
+
+def test_rate_is_split_across_processes():
+    controller = make_controller(rate_per_second=6, burst=9, processes=3)
+    assert controller.bucket.rate == 2
+    assert controller.bucket.capacity == 3
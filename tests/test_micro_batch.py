@@ -0,0 +1,123 @@
+# Micro-batch runner against the in-memory sink: watermarks, commit triggers, sink failures, compaction
+import time
+
+import pytest
+
+pytest.importorskip('pandas')
+# The transforms validate against the clean table schemas, which are BigQuery SchemaFields
+pytest.importorskip('google.cloud.bigquery')
+
+import pandas as pd
+
+from scripts.micro_batch import InMemorySink, MicroBatchRunner
+
+def user(user_id, city='Nairobi'):
+    return {
+        'id': user_id,
+        'firstName': f"First{user_id}",
+        'lastName': f"Last{user_id}",
+        'gender': 'female',
+        'age': 30,
+        'address': {'address': f"{user_id} Main Street", 'city': city, 'postalCode': '00100'},
+    }
+
+class ScriptedFetch:
+    """Returns the next scripted users payload on every poll (the last one once the script runs out)"""
+
+    def __init__(self, *payloads):
+        self.payloads = list(payloads)
+
+    def __call__(self, api_url, data_type, last_poll):
+        users = self.payloads.pop(0) if len(self.payloads) > 1 else self.payloads[0]
+        return {'users': users, 'total': len(users), 'skip': 0, 'limit': len(users)}
+
+class FlakySink(InMemorySink):
+    """In-memory sink whose first `failures` appends raise"""
+
+    def __init__(self, failures):
+        super().__init__()
+        self.failures = failures
+
+    def append(self, data_type, df):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("streaming insert failed")
+        super().append(data_type, df)
+
+def make_runner(sink, fetch, **overrides):
+    settings = {'batch_size': 1000, 'commit_interval': 3600, 'compaction_interval': 3600, **overrides}
+    return MicroBatchRunner(sink, data_types=['users'], fetch=fetch, sketches=False, **settings)
+
+def buffered_ids(runner):
+    return sorted(int(user_id) for df in runner.buffers['users'] for user_id in df['user_id'])
+
+def test_only_records_above_the_watermark_are_buffered():
+    runner = make_runner(InMemorySink(), ScriptedFetch([user(1), user(2), user(3)], [user(i) for i in range(1, 6)]),
+                         watermarks={'users': 1})
+
+    runner.poll_once()
+    assert buffered_ids(runner) == [2, 3]
+    assert runner.watermarks['users'] == 3
+
+    runner.poll_once()
+    assert buffered_ids(runner) == [2, 3, 4, 5]
+    assert runner.watermarks['users'] == 5
+
+def test_commit_when_the_batch_size_is_reached():
+    sink = InMemorySink()
+    runner = make_runner(sink, ScriptedFetch([user(1), user(2)], [user(1), user(2), user(3)]), batch_size=3)
+
+    runner.run_cycle()
+    assert sink.commits == 0 and runner.buffered_rows() == 2
+
+    runner.run_cycle()
+    assert sink.commits == 1 and runner.buffered_rows() == 0
+    assert sorted(row['user_id'] for row in sink.stream['users']) == [1, 2, 3]
+
+def test_commit_when_the_commit_interval_elapses():
+    sink = InMemorySink()
+    runner = make_runner(sink, ScriptedFetch([user(1)]), commit_interval=60)
+
+    runner.run_cycle()
+    assert sink.commits == 0 and runner.buffered_rows() == 1
+
+    runner.last_commit = time.monotonic() - 61
+    runner.run_cycle()
+    assert sink.commits == 1 and runner.buffered_rows() == 0
+
+def test_failed_append_keeps_the_buffer_and_retries_next_cycle():
+    sink = FlakySink(failures=1)
+    runner = make_runner(sink, ScriptedFetch([user(1), user(2)]), batch_size=1)
+
+    runner.run_cycle()
+    assert runner.buffered_rows() == 2
+    assert runner.stats['sink_errors'] == 1
+    assert sink.stream['users'] == []
+
+    runner.run_cycle()
+    assert runner.buffered_rows() == 0
+    assert sorted(row['user_id'] for row in sink.stream['users']) == [1, 2]
+    assert runner.stats['rows_streamed'] == 2
+
+def test_compaction_keeps_the_latest_version_of_each_row():
+    sink = InMemorySink()
+    sink.append('users', pd.DataFrame({
+        'user_id': [1, 2],
+        'city': ['Nairobi', 'Mombasa'],
+        'load_timestamp': pd.to_datetime(['2025-01-01 10:00', '2025-01-01 10:00']),
+    }))
+    sink.append('users', pd.DataFrame({
+        'user_id': [1],
+        'city': ['Kisumu'],
+        'load_timestamp': pd.to_datetime(['2025-01-01 11:00']),
+    }))
+    # An older version arriving late must not win
+    sink.append('users', pd.DataFrame({
+        'user_id': [2],
+        'city': ['Nakuru'],
+        'load_timestamp': pd.to_datetime(['2025-01-01 09:00']),
+    }))
+
+    sink.compact('users')
+    assert sink.stream['users'] == []
+    assert {key[0]: row['city'] for key, row in sink.clean['users'].items()} == {1: 'Kisumu', 2: 'Mombasa'}